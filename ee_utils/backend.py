@@ -0,0 +1,360 @@
+'''
+The backend that answers the requests to GEE. All the code that talks to GEE goes through this module: the ee objects are built with the ee of this
+module (from ee_utils.backend import ee), the getInfo requests go through get_backend().get_info and the getDownloadUrl requests through
+get_backend().download_url. There are two backends, selected with backend.name in the config:
+    ee: the Earth Engine API. It is initialized (config/ee_init.py) the first time it is used, and not when the modules are imported.
+    fake: a local stand-in for GEE, to run ee_set, main_download.py and the export path without GEE access or credentials, e.g. to test the
+          concurrency, retry and resume machinery on a laptop. The ee objects are only recorded, and the requests are answered with synthetic values
+          after a random latency, and fail or are throttled at the configured rates. The images are served from {root}/npy and {root}/geotiff if
+          these folders exist, and are synthetic otherwise. The answers of getInfo can be replaced by the values of {root}/responses.json.
+
+The fake answers a getInfo with one synthetic value per key of the resolved dictionary (see FakeBackend.respond), hence it knows the keys used by
+ee_data.py, ee_discovery.py and ee_mosaic.py. A new key has to be added there, or to responses.json.
+'''
+
+import glob
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+from urllib.parse import urlencode, urlparse, parse_qs
+import numpy as np
+import requests
+from requests.adapters import BaseAdapter
+
+from utils.download import get_session
+from utils.modalities import MODALITIES
+
+
+class EarthEngineBackend:
+    name = 'ee'
+
+    def __init__(self):
+        import ee
+        self.ee = ee
+
+    def initialize(self):
+        import config.ee_init
+
+    def get_info(self, obj):
+        return obj.getInfo()
+
+    def download_url(self, image, params):
+        return image.getDownloadUrl(params)
+
+
+################################################################################################################################################################
+# THE FAKE BACKEND
+################################################################################################################################################################
+
+class FakeEEException(Exception):
+    pass
+
+
+class FakeObject:
+    '''
+    A recorded ee object. Any method call returns a new FakeObject that keeps the name, the arguments and the object it was called on, so the fake
+    can look at how an object was built (e.g. the tiles of a FeatureCollection) when it answers a request.
+    '''
+    def __init__(self, name, args = (), kwargs = None, parent = None):
+        self._name = name
+        self._args = args
+        self._kwargs = kwargs or {}
+        self._parent = parent
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return FakeObject(name, parent=self)
+
+    def __call__(self, *args, **kwargs):
+        return FakeObject(self._name, args, kwargs, self._parent)
+
+    def _source(self):
+        '''
+        Returns the first object with arguments in the chain of calls, e.g. the Point of ee.Geometry.Point([lon, lat]).transform(crs).coordinates().
+        '''
+        obj, source = self, None
+        while obj is not None:
+            if len(obj._args) > 0:
+                source = obj
+            obj = obj._parent
+        return source
+
+    def __repr__(self):
+        return f"{self._parent!r}.{self._name}(...)" if self._parent is not None else f"ee.{self._name}(...)"
+
+
+# the methods that do not change the bands of an image or of a collection
+KEEP_BANDS = ['clip', 'float', 'resample', 'reproject', 'first', 'mode', 'map', 'filterBounds', 'filterDate', 'where']
+
+
+def fake_bands(obj):
+    '''
+    Returns the band names of a recorded image, from the select, rename, addBands and Image.cat calls that built it, or None if they are not known
+    (e.g. an image loaded by its id and never selected). The synthetic image of a download has the same number of bands as the tile_info reports.
+    '''
+    if not isinstance(obj, FakeObject):
+        return None
+    name, args, parent = obj._name, obj._args, obj._parent
+    if name in ['select', 'rename'] and len(args) > 0:
+        return list(args[0]) if isinstance(args[0], (list, tuple)) else [args[0]]
+    if name == 'cat' and len(args) > 0:
+        bands = [fake_bands(image) for image in args[0]]
+        return None if None in bands else [band for image_bands in bands for band in image_bands]
+    if name == 'addBands' and len(args) > 0:
+        bands, other = fake_bands(parent), fake_bands(args[0])
+        return None if bands is None or other is None else bands + other
+    if name == 'slope':
+        return ['slope']
+    if name in KEEP_BANDS and parent is not None:
+        return fake_bands(parent)
+    return None
+
+
+class FakeEE:
+    '''
+    Stand-in for the ee module: ee.Image, ee.Filter, ee.Algorithms.If, ... all return FakeObjects.
+    '''
+    EEException = FakeEEException
+    ee_exception = SimpleNamespace(EEException=FakeEEException)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return FakeObject(name)
+
+
+# the synthetic bands of the images, from the registry
+S2_BANDS = [band for name in ['sentinel2', 'sentinel2_cloudmask', 'sentinel2_cloudprod', 'sentinel2_scl'] for band in MODALITIES[name]['bands']]
+S1_BANDS = ['VV', 'VH']
+ERA5_BANDS = [f"{period}_{band}" for period in ['month1', 'month2', 'year'] for band in ['temperature_2m', 'temperature_2m_min', 'temperature_2m_max', 'total_precipitation_sum']]
+METERS_PER_DEGREE = 111320
+
+
+class FakeBackend:
+    name = 'fake'
+
+    def __init__(self, root = None, latency = 0.1, download_latency = 0.2, failure_rate = 0.0, throttle_rate = 0.0, no_data_rate = 0.0,
+                 image_size = 140, num_bands = 8, seed = 0):
+        '''
+        latency and download_latency are the mean times in seconds of a request to GEE and of a download. failure_rate and throttle_rate are the
+        probabilities that a request fails, or is rejected with a rate limit error (a 429 for the downloads). no_data_rate is the probability that
+        there is no sentinel2 image for a tile. The synthetic images are image_size x image_size (unless the request gives the dimensions) with one float32
+        band per band of the image (see fake_bands), or num_bands bands if they are not known.
+        '''
+        self.ee = FakeEE()
+        self.root = root
+        self.latency = latency
+        self.download_latency = download_latency
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.no_data_rate = no_data_rate
+        self.image_size = image_size
+        self.num_bands = num_bands
+        self.rng = random.Random(seed)
+        self.counter = 0
+        self.lock = threading.Lock()
+
+        self.responses = {}
+        self.files = {'NPY': [], 'GeoTIFF': []}
+        if root is not None:
+            if os.path.exists(f"{root}/responses.json"):
+                with open(f"{root}/responses.json", 'r') as f:
+                    self.responses = json.load(f)
+            self.files['NPY'] = sorted(glob.glob(f"{root}/npy/*.npy"))
+            self.files['GeoTIFF'] = sorted(glob.glob(f"{root}/geotiff/*.tif"))
+        self.adapter = FakeAdapter(self)
+
+    def initialize(self):
+        # the download urls are fake://, and are answered by the adapter instead of the network. configure_session has to be called before this
+        get_session().mount('fake://', self.adapter)
+        logging.info(f"Using the fake GEE backend (root: {self.root})")
+
+    def request(self, latency):
+        '''
+        Waits like a request, and raises the failures.
+        '''
+        time.sleep(self.rng.uniform(0.5, 1.5) * latency)
+        draw = self.rng.random()
+        if draw < self.throttle_rate:
+            raise FakeEEException('Too many concurrent aggregations.')
+        if draw < self.throttle_rate + self.failure_rate:
+            raise FakeEEException('Internal error (fake backend).')
+
+    def next_id(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def get_info(self, obj):
+        self.request(self.latency)
+        # resolve() wraps the values in ee.Dictionary, and the selections are ee.Dictionary themselves
+        while isinstance(obj, FakeObject) and obj._name == 'Dictionary' and len(obj._args) == 1:
+            obj = obj._args[0]
+        if not isinstance(obj, dict):
+            raise FakeEEException(f"The fake backend can only resolve dictionaries, got {obj!r}")
+        return {key: self.respond(key, value) for key, value in obj.items()}
+
+    def respond(self, key, value):
+        '''
+        Returns the synthetic value of one key of a resolved dictionary.
+        '''
+        if key in self.responses:
+            return self.responses[key]
+        if not isinstance(value, FakeObject):
+            return value
+        if key == 'type':
+            return 'l2a'
+        if key == 'image':
+            return self.s2_image()
+        if key in ['asc', 'desc']:
+            return {'id': f"COPERNICUS/S1_GRD/FAKE_{self.next_id()}", 'bands': S1_BANDS}
+        if key == 'bands':
+            # image.bandNames()
+            bands = fake_bands(value._parent)
+            return bands if bands is not None else [f"b{i + 1}" for i in range(self.num_bands)]
+        if key == 'band_names':
+            return ERA5_BANDS
+        if key == 'values':
+            return {band: self.rng.uniform(0, 300) for band in ERA5_BANDS}
+        if key == 'centers':
+            # ee.List of Point(...).transform(...).coordinates(), a simple equirectangular projection is enough to group the tiles
+            centers = []
+            for point in value._args[0]:
+                lon, lat = point._source()._args[0]
+                centers.append([lon * METERS_PER_DEGREE * math.cos(math.radians(lat)), lat * METERS_PER_DEGREE])
+            return centers
+        if key in ['l2a', 'l1c']:
+            # the batch discovery: FeatureCollection(features).map(...).aggregate_array('result')
+            results = []
+            for feature in value._source()._args[0]:
+                results.append({
+                    'tile_id': feature._args[1]['tile_id'],
+                    's2': {'type': key, 'image': self.s2_image()},
+                    's1': {'asc': self.respond('asc', value), 'desc': self.respond('desc', value)},
+                })
+            return results
+        raise FakeEEException(f"The fake backend has no response for '{key}', add it to responses.json")
+
+    def s2_image(self):
+        if self.rng.random() < self.no_data_rate:
+            return None
+        return {'id': f"COPERNICUS/S2_SR_HARMONIZED/FAKE_{self.next_id()}", 'date': '2019-06-15', 'bands': S2_BANDS, 'crs': 'EPSG:32632'}
+
+    def download_url(self, image, params):
+        self.request(self.latency)
+        bands = fake_bands(image)
+        query = {'format': params.get('format', 'GeoTIFF'), 'dimensions': params.get('dimensions', ''), 'bands': len(bands) if bands is not None else self.num_bands,
+                 'id': self.next_id()}
+        return f"fake://download/?{urlencode(query)}"
+
+    def content(self, url):
+        '''
+        Returns the bytes of the image of a download url: one of the files of the root folder, or a synthetic image.
+        '''
+        query = parse_qs(urlparse(url).query)
+        format = query['format'][0]
+        files = self.files.get(format, [])
+        if len(files) > 0:
+            digest = int(hashlib.sha1(url.encode()).hexdigest(), 16)
+            with open(files[digest % len(files)], 'rb') as f:
+                return f.read()
+
+        if 'dimensions' in query:
+            width, height = [int(v) for v in query['dimensions'][0].split('x')]
+        else:
+            width = height = self.image_size
+        num_bands = int(query['bands'][0])
+        rng = np.random.default_rng(int(query['id'][0]))
+        data = rng.normal(size=(height, width, num_bands)).astype(np.float32)
+        buffer = io.BytesIO()
+        if format == 'NPY':
+            # the same structured array as the NPY downloads of GEE, one field per band
+            dtype = np.dtype([(f"b{i + 1}", np.float32) for i in range(num_bands)])
+            np.save(buffer, np.ascontiguousarray(data).view(dtype).reshape(height, width))
+        else:
+            import tifffile as tiff
+            tiff.imwrite(buffer, data)
+        return buffer.getvalue()
+
+
+class FakeAdapter(BaseAdapter):
+    '''
+    requests adapter that answers the fake:// download urls.
+    '''
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+
+    def send(self, request, **kwargs):
+        backend = self.backend
+        time.sleep(backend.rng.uniform(0.5, 1.5) * backend.download_latency)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        draw = backend.rng.random()
+        if draw < backend.throttle_rate:
+            response.status_code, content = 429, b''
+        elif draw < backend.throttle_rate + backend.failure_rate:
+            response.status_code, content = 500, b''
+        else:
+            response.status_code, content = 200, backend.content(request.url)
+        response.headers['Content-Length'] = str(len(content))
+        response.raw = io.BytesIO(content)
+        return response
+
+    def close(self):
+        pass
+
+
+################################################################################################################################################################
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def configure_backend(cfg = None):
+    '''
+    Creates and initializes the process wide backend from the backend section of the config (None for the Earth Engine API).
+    '''
+    global _backend
+    if cfg is None or cfg.name == 'ee':
+        backend = EarthEngineBackend()
+    elif cfg.name == 'fake':
+        backend = FakeBackend(**cfg.fake)
+    else:
+        raise ValueError(f"Unknown backend {cfg.name}")
+    backend.initialize()
+    with _backend_lock:
+        _backend = backend
+    return backend
+
+
+def get_backend():
+    '''
+    Returns the process wide backend. The Earth Engine API is used if configure_backend was not called.
+    '''
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = EarthEngineBackend()
+            _backend.initialize()
+        return _backend
+
+
+class _EEModule:
+    '''
+    The ee module of the backend in use, so that the ee objects are built with the fake ee when the fake backend is configured.
+    '''
+    def __getattr__(self, name):
+        return getattr(get_backend().ee, name)
+
+
+ee = _EEModule()
@@ -0,0 +1,46 @@
+'''
+Helpers to run the blocking GEE calls concurrently. Once the date and projection of the sentinel2 image are known, the other datasets of a tile are
+independent of each other, so we run them at the same time with asyncio, and the time for a tile is close to the slowest dataset instead of the sum.
+
+All the requests to GEE of a process (all tiles, all datasets) go through one semaphore, so the number of requests in flight stays within the GEE quota
+no matter how many tiles and datasets run at the same time.
+'''
+
+import asyncio
+import threading
+from contextlib import contextmanager
+
+
+_ee_semaphore = threading.BoundedSemaphore(40)
+
+
+def configure_ee_concurrency(max_requests):
+    '''
+    Sets the maximum number of requests to GEE that a process sends at the same time.
+    '''
+    global _ee_semaphore
+    _ee_semaphore = threading.BoundedSemaphore(max_requests)
+
+
+@contextmanager
+def ee_request_slot():
+    '''
+    Context manager to wrap every blocking request to GEE (getInfo, getDownloadUrl). It waits until a slot of the global semaphore is free.
+    '''
+    semaphore = _ee_semaphore
+    with semaphore:
+        yield
+
+
+async def _gather(funcs):
+    return await asyncio.gather(*[asyncio.to_thread(func) for func in funcs])
+
+
+def run_concurrently(funcs):
+    '''
+    Runs the given functions (without arguments) concurrently in threads and returns their results in the same order.
+    If a function raises an exception, the exception is raised here.
+    '''
+    if len(funcs) == 0:
+        return []
+    return asyncio.run(_gather(funcs))
@@ -3,56 +3,181 @@ A general class to collect the data from GEE. Each function in the class will be
 '''
 
 import io
-import config.ee_init
-import ee
-from matplotlib import pyplot as plt
+from ee_utils.backend import ee, get_backend
 import numpy as np
-import requests
-import shutil
-import zipfile
 import os
 import logging
-from utils.utils import get_points_filter, get_ee_task_list, read_json
-import math
+from utils.utils import read_json
+from utils.geometry import centroid, bounds, tile_region, tile_seed, grid_cell
+from utils.cache import get_cache
+from ee_utils.ee_async import ee_request_slot, run_concurrently
+from utils.download import stream_to_file, rate_limited_get, DownloadError
+from utils.rate_limiter import get_rate_limiter
+from utils.metrics import TileMetrics
+from utils.modalities import DATASETS
+from utils.ledger import DOWNLOADED, FAILED, NO_DATA
+from utils.array_store import shard_path, write_array
 import random
 import time
 from numpy.lib import recfunctions as rfn
-import h5py
 from retry import retry
 from multiprocessing import Pool, cpu_count
 from datetime import datetime, timedelta
-import hashlib
 
 BIOME_LABELS = read_json('./stats/biome_labels.json')
 ECOREGION_LABELS = read_json('./stats/eco_labels.json')
 
+# the start and end date specify the general time period for the data. The specific date is specified in the function. We consider a 2 year period
+START_DATE = '2017-01-01'
+END_DATE = '2020-12-31'
+
+
+def resolve(values):
+    '''
+    Resolves a dictionary of ee objects with a single getInfo() call, instead of one round trip to GEE per value. 
+    Returns a python dictionary with the same keys.
+    '''
+    return ee_call(lambda: get_backend().get_info(ee.Dictionary(values)))
+
+
+def ee_call(func):
+    '''
+    Runs one blocking request to GEE (getInfo, getDownloadUrl), given as a function without arguments. The request goes through the process wide 'ee'
+    rate limiter, which lowers the rate and retries when GEE answers with a 429 or "Too many concurrent aggregations", and through the semaphore that
+    bounds the number of requests in flight.
+    '''
+    def request():
+        with ee_request_slot():
+            return func()
+    return get_rate_limiter('ee').call(request)
+
+
+def s2_sampling(rng):
+    '''
+    Draws the parameters of the sentinel2 sampling of a tile from its random generator: the date window (a random year), whether to use l2a or l1c,
+    and the seed of the random column used to pick the image. The draws are always made in this order, so the same tile always gets the same image.
+    '''
+    rnd_year = rng.randint(2017, 2020)
+    if rnd_year == 2018:
+        # we only go up to november 2018 since l2a is global from dec 2018
+        s_date = f"{rnd_year}-01-01"
+        e_date = f"{rnd_year}-11-30"
+    elif rnd_year == 2017 or rnd_year == 2020:
+        s_date = f"{rnd_year}-01-01"
+        e_date = f"{rnd_year}-12-31"
+    elif rnd_year == 2019:
+        # we also include dec 2018
+        s_date = f"{rnd_year - 1}-12-01"
+        e_date = f"{rnd_year}-12-31"
+
+    use_l2a = rng.randint(0, 1) == 0
+    selection_seed = rng.randint(0, 2**31 - 1)
+    return s_date, e_date, use_l2a, selection_seed
+
+
+def s2_selection(polygon, s_date, e_date, use_l2a, seed, cfg, cld_threshold = 10):
+    '''
+    Selects the sentinel2 image of a tile server side, and returns an ee.Dictionary with the type ('l2a' or 'l1c') and the image, which is a dictionary
+    with the id, date, bands and crs of the image, or None if there is no image. Nothing is resolved here, so the selection can be resolved in one
+    request for a tile, or mapped over a FeatureCollection of tiles.
+
+    The candidates are the images of the date window with few clouds that contain the tile (plus a buffer). We only fall back to l1c if there is
+    no l2a image at all for the tile. Instead of materializing the list of candidates and picking a random index, each candidate gets a random
+    number from the seed, and the image with the smallest number is selected.
+    '''
+    contains_filter = ee.Filter.contains('.geo', ee.Geometry(polygon).buffer(200))
+
+    def candidates(collection):
+        return ee.ImageCollection(collection)\
+                .filterBounds(polygon)\
+                .filterDate(s_date, e_date)\
+                .filterMetadata('CLOUDY_PIXEL_PERCENTAGE', 'less_than', cld_threshold)
+
+    S2_l1c = candidates(cfg.collection[1]).filter(contains_filter)
+    if use_l2a:
+        S2_l2a = candidates(cfg.collection[0])
+        has_l2a = S2_l2a.size().gt(0)
+        filtered_images = ee.ImageCollection(ee.Algorithms.If(has_l2a, S2_l2a.filter(contains_filter), S2_l1c))
+        s2_type = ee.Algorithms.If(has_l2a, 'l2a', 'l1c')
+    else:
+        filtered_images = S2_l1c
+        s2_type = 'l1c'
+
+    sampled_image = ee.Image(filtered_images.randomColumn('rnd', seed).sort('rnd').first())
+    image_meta = ee.Dictionary({
+        'id': sampled_image.get('system:id'),
+        'date': sampled_image.date().format('YYYY-MM-dd'),
+        'bands': sampled_image.bandNames(),
+        'crs': sampled_image.select('B4').projection().crs(),
+    })
+    return ee.Dictionary({
+        'type': s2_type,
+        'image': ee.Algorithms.If(filtered_images.size().gt(0), image_meta, None),
+    })
+
+
+def s1_selection(polygon, s2_date, collection, start_date, end_date):
+    '''
+    Selects the sentinel1 images of a tile server side, the ascending and descending images closest in time to the sentinel2 date. Returns an
+    ee.Dictionary with the keys 'asc' and 'desc', each a dictionary with the id and bands of the image, or None if there is no image for the orbit.
+    '''
+    img = (ee.ImageCollection(collection)
+                    .filterDate(start_date, end_date) # gets images in the specified date range
+                    .filterBounds(polygon) # gets images that have some overlap with the tile
+                    .filter(ee.Filter.contains('.geo', ee.Geometry(polygon).buffer(200))) # gets images containing the tile plus some buffer
+                    .filterMetadata('instrumentMode', 'equals', 'IW') # selects for the interferometric wide swath mode
+                    .map(lambda image: image.set('date_difference', image.date().difference(ee.Date(s2_date), 'day').abs())) # calculate days off from S2 image
+                    .sort('date_difference')) # sort in ascending order by days off
+
+    def orbit_meta(orbit):
+        image = img.filterMetadata('orbitProperties_pass', 'equals', orbit).first()
+        return ee.Algorithms.If(image, ee.Dictionary({'id': ee.Image(image).get('system:id'), 'bands': ee.Image(image).bandNames()}), None)
+
+    return ee.Dictionary({'asc': orbit_meta('ASCENDING'), 'desc': orbit_meta('DESCENDING')})
+
+
+def discovered_s2_selection(discovered):
+    '''
+    Returns the sentinel2 selection of a tile, in the format of s2_selection, from its record in the discovery file.
+    '''
+    if discovered['NO_DATA']:
+        return {'type': discovered['S2_type'], 'image': None}
+    return {
+        'type': discovered['S2_type'],
+        'image': {'id': discovered['S2_IMAGEID'], 'date': discovered['S2_DATE'], 'bands': discovered['S2_BANDS'], 'crs': discovered['CRS']},
+    }
+
 
 class ee_set:
-    def __init__(self, tile, cfg, tile_info = None):
+    def __init__(self, tile, cfg, tile_info = None, discovered = None):
         self.tile = tile
         self.crs = ''
-        self.start_date = '2017-01-01' # the start date specifies the general time period for the data. The specific date is specified in the function. We consider a 2 year period
-        self.end_date = '2020-12-31' # the end date specifies the general time period for the data. The specific date is specified in the function. We consider a 2 year period
+        self.start_date = START_DATE
+        self.end_date = END_DATE
         self.s2_date = ''
         self.s2_imageid = ''
         self.id = tile['properties']['tile_id'] 
+        self.metrics = TileMetrics(self.id) # the time spent in each stage of the download, see utils/metrics.py
         self.polygon = ee.Geometry.Polygon(tile['geometry']['coordinates'])
-        self.lon = self.polygon.centroid().coordinates().get(0).getInfo()
-        self.lat = self.polygon.centroid().coordinates().get(1).getInfo()
+        self.region = tile_region(tile) # the coordinates of the polygon, used when exporting the images
+        self.lon, self.lat = centroid(tile['geometry']['coordinates'])
+        self.bounds = bounds(tile['geometry']['coordinates'])
         self.biome = BIOME_LABELS[tile['properties']['biome']]
         self.eco_region = ECOREGION_LABELS[tile['properties']['eco_region']]
         self.cfg = cfg  # loading the config file
         self.export_folder = self.cfg.export_folder
         self.image_set = {}
         self.no_data = False
-        self.return_dict = {} # dict to store the arr returned by export_pixels NOT USED
+        self.failed = False # set when the data could not be retrieved because of an error, unlike no_data the tile can be tried again
+        self.states = {} # the state of each dataset for the ledger: downloaded, no_data (no image for the tile) or failed (an error)
         self.img_bands = {} # a dictionary that stores the bands of each dataset acquired
         self.era5_data = {}
+        self.downloaded = {} # the size and sha256 checksum of each downloaded file, by its path in export_folder. Stored in the tile_info as FILES
         self.proj = None
         self.s2_type = None
-        coord_string = f"{self.lat}_{self.lon}"
-        self.seed = int(hashlib.sha256(coord_string.encode('utf-8')).hexdigest(), 16) % 10**5
-        random.seed(self.seed)
+        self.discovered = discovered # the sentinel2 and sentinel1 images of the tile, if they were selected by the batch discovery
+        self.seed = tile_seed(self.lat, self.lon)
+        self.rng = random.Random(self.seed) # one generator per tile, so that tiles downloaded in parallel threads do not share the random state
 
 
         
@@ -65,62 +190,135 @@ class ee_set:
                 self.proj = ee.Projection(self.crs).atScale(10)
 
 
-        # start series of function calls to get the data
-        for function_name in cfg.datasets:
-            if hasattr(self, function_name) and callable(getattr(self, function_name)):
-                if getattr(self, function_name)() is False:
-                    logging.error(f"Function {function_name} returned None")
+        # start series of function calls to get the data. sentinel2 gives the date and projection used by the other datasets, hence it runs first
+        datasets = list(cfg.datasets)
+        if 'sentinel2' in datasets:
+            with self.metrics.stage('sentinel2'):
+                s2_result = self.sentinel2()
+            if s2_result is False:
+                logging.error("Function sentinel2 returned None")
+                logging.error(f"Skipping tile {self.id}")
+                self.no_data = True
+                # without sentinel2 the other datasets are not fetched, and they get the same state
+                for name in datasets:
+                    self.states[name] = FAILED if self.failed else NO_DATA
+            else:
+                self.states['sentinel2'] = DOWNLOADED
 
-                    if function_name == 'sentinel2':
-                        logging.error(f"Skipping tile {self.id}")
-                        self.no_data = True
-                        break
+        if not self.no_data:
+            # the function of each dataset is declared in the dataset registry (utils/modalities.py)
+            names = []
+            for name in datasets:
+                if name == 'sentinel2':
+                    continue
+                if name in DATASETS:
+                    names.append(name)
+                else:
+                    logging.error(f"Dataset {name} is not in the dataset registry")
+
+            # the other datasets are independent of each other, so they can run at the same time
+            timed_functions = [self.timed(name, getattr(self, DATASETS[name]['fetch'])) for name in names]
+            if cfg.async_modalities:
+                results = run_concurrently(timed_functions)
             else:
-                logging.error(f"Function {function_name} does not exist")
-            
-        
+                results = [function() for function in timed_functions]
+            for name, result in zip(names, results):
+                if result is False:
+                    logging.error(f"Function {DATASETS[name]['fetch']} returned None")
+                if name not in self.states:
+                    self.states[name] = self.dataset_state(name)
 
 
         # merging all the images into one image - comment these lines if you want to export the images seperately
+        # the images are merged in the order of the datasets in the config, since the bands of the merged image are read in this order
+        # the datasets without an image (no data, failed, or only stored in the tile_info like era5) are left out
         if not self.no_data:
-            merged_image = self.image_set[self.cfg.datasets[0]] 
-            for data_name, image in self.image_set.items():
-                if data_name == self.cfg.datasets[0]:
-                    continue
-
+            merged_image = None
+            for data_name in datasets:
+                image = self.image_set.get(data_name)
                 if isinstance(image, dict):
-                    for extra_info, img in image.items():
-                        if img is None:
-                            continue
-                        merged_image = ee.Image.cat([merged_image, img])
-                elif image is None:
-                    continue
+                    images = [img for img in image.values() if img is not None]
                 else:
-                    merged_image = ee.Image.cat([merged_image, image])
+                    images = [image] if image is not None else []
+                for img in images:
+                    merged_image = img if merged_image is None else ee.Image.cat([merged_image, img])
 
             self.image_set = {}
-            if tile_info is not None:
-                self.image_set['extra'] = merged_image
-            else:
-                self.image_set['merged'] = merged_image
+            if merged_image is not None:
+                if tile_info is not None:
+                    self.image_set['extra'] = merged_image
+                else:
+                    self.image_set['merged'] = merged_image
                     
                     
         if not self.no_data:
-            start = time.time()
             try:
-                self.export_local_single()
+                with self.metrics.stage('export'):
+                    if self.cfg.export_mode == 'pixels':
+                        self.export_pixels()
+                    else:
+                        self.export_local_single()
             except Exception as e:
                 logging.error(f"Error exporting to local directory: {e}")
                 self.no_data = True
+                self.failed = True
+                # all the datasets are exported in one merged image, so none of them was saved
+                for name, state in self.states.items():
+                    if state == DOWNLOADED:
+                        self.states[name] = FAILED
             # self.export_local_parallel()
-            logging.debug(f"Time taken for exporting all: {time.time() - start}")
             
         
 
 
+    def resolve(self, values):
+        '''
+        resolve() that adds the time of the request to the metadata stage of the tile.
+        '''
+        with self.metrics.stage('metadata'):
+            return resolve(values)
+
+
+    def timed(self, name, function):
+        '''
+        Wraps the function of a dataset, so that its time is recorded in the stage with the name of the function. An error in the function only fails
+        this dataset, the other datasets of the tile are still exported.
+        '''
+        def run():
+            with self.metrics.stage(function.__name__):
+                try:
+                    return function()
+                except Exception as e:
+                    logging.error(f"Dataset {name} failed for tile {self.id}: {e}")
+                    self.states[name] = FAILED
+                    return False
+        return run
+
+
+    def dataset_state(self, name):
+        '''
+        Returns the state of a dataset once its function ran: no_data if the tile has none of its images (e.g. no sentinel1 image in any orbit, no
+        dynamic world image), downloaded otherwise. The datasets that are only stored in the tile_info (era5) have no image.
+        '''
+        if len(DATASETS[name]['image_keys']) == 0:
+            return DOWNLOADED
+        image = self.image_set.get(self.cfg[name].name)
+        if isinstance(image, dict):
+            image = next((img for img in image.values() if img is not None), None)
+        return NO_DATA if image is None else DOWNLOADED
+
+
+    def cached_band_names(self, key, image):
+        '''
+        Returns the band names of an image whose bands do not depend on the tile (e.g. a single global image). The band names are resolved once and cached
+        for all the following tiles.
+        '''
+        return get_cache().get_or_compute(key, lambda: self.resolve({'bands': image.bandNames()})['bands'])
+
+
     ################################################################################################################################################################################################
     # THE FOLLOWING SET OF FUNCTIONS ARE FOR GETTING THE DATA FROM GEE. WRITE A NEW FUNCTION FOR EACH DATASET
-    # MAKE SURE THE NAME OF THE FUNCTION IS THE SAME AS THE NAME OF THE DATASET IN THE CONFIG FILE
+    # MAKE SURE THE NAME OF THE FUNCTION IS THE SAME AS THE NAME OF THE DATASET IN THE CONFIG FILE, AND ADD THE DATASET TO THE REGISTRY IN utils/modalities.py
     # FOR EACH FUNCTION YOU RETURN A DICTIONARY WITH THE NAME OF THE DATASET AS THE KEY AND THE IMAGE AS THE VALUE
     ################################################################################################################################################################################################
     def sentinel2(self, cld_threshold = 10):
@@ -131,84 +329,46 @@ class ee_set:
         S2 is used as the base image, and hence we get the date and projection from this image. The bands are selected from the config file.
         
         '''
-        start = time.time() 
 
         cfg = self.cfg.sentinel2
         data_name = cfg.name
         bands_l2a = list(cfg.BANDS[0])
         bands_l1c = list(cfg.BANDS[1])
-        collection_l2a = cfg.collection[0]
-        collection_l1c = cfg.collection[1]
-
-
-        rnd_year = random.randint(2017, 2020)
-        if rnd_year == 2018:
-            # we only go up to november 2018 since l2a is global from dec 2018
-            s_date = f"{rnd_year}-01-01"
-            e_date = f"{rnd_year}-11-30"
-        elif rnd_year == 2017 or rnd_year == 2020:
-            s_date = f"{rnd_year}-01-01"
-            e_date = f"{rnd_year}-12-31"
-        elif rnd_year == 2019:
-            # we also include dec 2018
-            s_date = f"{rnd_year - 1}-12-01"
-            e_date = f"{rnd_year}-12-31"
-
-        # random.seed(self.seed)
-        if random.randint(0, 1) == 0:
-            S2 = ee.ImageCollection(collection_l2a)\
-                    .filterBounds(self.polygon)\
-                    .filterDate(f"{s_date}", f"{e_date}")\
-                    .filterMetadata('CLOUDY_PIXEL_PERCENTAGE', 'less_than', cld_threshold)
-            self.s2_type = 'l2a'
-            
-            if S2.size().getInfo() == 0:
-                S2 = ee.ImageCollection(collection_l1c)\
-                    .filterBounds(self.polygon)\
-                    .filterDate(f"{s_date}", f"{e_date}")\
-                    .filterMetadata('CLOUDY_PIXEL_PERCENTAGE', 'less_than', cld_threshold)
-                self.s2_type = 'l1c'
-        else:
-            S2 = ee.ImageCollection(collection_l1c)\
-                    .filterBounds(self.polygon)\
-                    .filterDate(f"{s_date}", f"{e_date}")\
-                    .filterMetadata('CLOUDY_PIXEL_PERCENTAGE', 'less_than', cld_threshold)
-            self.s2_type = 'l1c'
-            
-        # points_filter = get_points_filter(self.polygon, buffer_size = -200)
-        # filtered_images = S2.filter(points_filter)
 
-        filtered_images = S2.filter(ee.Filter.contains('.geo', self.polygon.buffer(200)))
+        if self.discovered is not None:
+            # the image was already selected by the batch discovery (ee_utils/ee_discovery.py), with the same random choices as below
+            selection = discovered_s2_selection(self.discovered)
+        else:
+            s_date, e_date, use_l2a, selection_seed = s2_sampling(self.rng)
 
-        num_filtered_images = filtered_images.size().getInfo()
-        if num_filtered_images == 0:
+            # the image is sampled server side, and its id, date, type, bands and projection are resolved in one request
+            try:
+                selection = self.resolve(s2_selection(self.polygon, s_date, e_date, use_l2a, selection_seed, cfg, cld_threshold))
+            except ee.ee_exception.EEException as e:
+                logging.error(f"Error resolving the sentinel2 image: {e}")
+                self.failed = True
+                return False
+
+        self.s2_type = selection['type']
+        s2_meta = selection['image']
+        if s2_meta is None:
             logging.error('\t No sentinel2 image found for both l1c and l2a')
             return False
-        img_list = filtered_images.toList(filtered_images.size())
-        random_number = random.randint(0, num_filtered_images - 1)
-        sampled_image_full = ee.Image(img_list.get(random_number))
+        self.s2_imageid = s2_meta['id']
+        # loading the image by its id, so that the export does not have to filter and sort the collection again
+        sampled_image_full = ee.Image(self.s2_imageid)
+
         # Select the desired bands and clip the image
         if self.s2_type == 'l2a':
-            if "MSK_CLDPRB" in sampled_image_full.bandNames().getInfo():
-                sampled_image = sampled_image_full.select(bands_l2a).clip(self.polygon).float()
-            else:
-                new_bands = [band for band in bands_l2a if band != 'MSK_CLDPRB']
-                bands_l2a = new_bands
-                sampled_image = sampled_image_full.select(new_bands).clip(self.polygon).float()
+            if "MSK_CLDPRB" not in s2_meta['bands']:
+                bands_l2a = [band for band in bands_l2a if band != 'MSK_CLDPRB']
+            sampled_image = sampled_image_full.select(bands_l2a).clip(self.polygon).float()
         else:
             sampled_image = sampled_image_full.select(bands_l1c).clip(self.polygon).float()
 
-
-        try:
-            self.s2_date = sampled_image.date().format('YYYY-MM-dd').getInfo()
-        except ee.ee_exception.EEException:
-            tmp  = ee.Image(img_list.get(random_number))
-            logging.error(f"type: {self.s2_type}, num images in collection: {num_filtered_images}")
-            logging.error(f"bands: {tmp.bandNames().getInfo()}")
-
-        tmp = sampled_image.select('B4')
-        self.proj = tmp.projection()
-        self.crs = self.proj.getInfo()['crs']
+        self.s2_date = s2_meta['date']
+        self.proj = sampled_image.select('B4').projection()
+        self.crs = s2_meta['crs']
 
         logging.debug(f"\t ID: {self.id}\
                 \nBiome name: {self.tile['properties']['biome']}\
@@ -216,7 +376,7 @@ class ee_set:
                 \nDate: {self.s2_date}\
                 \nProjection: {self.crs}\
                 \nLat: {self.lat} Lon: {self.lon}\
-                \nPolygon: {self.polygon.getInfo()['coordinates']}\
+                \nPolygon: {self.region}\
                 \nS2 type:{self.s2_type}"\
                 )
         if self.s2_type == 'l2a':
@@ -228,9 +388,12 @@ class ee_set:
             sampled_image = sampled_image.select([band for band in bands_l1c if band != 'QA60']).resample('bilinear').reproject(self.proj)
             sampled_image = sampled_image.addBands(qa60)
         self.image_set[data_name] = sampled_image
-        self.img_bands[data_name] = sampled_image.bandNames().getInfo()
+        # the band order is known from the selection above, the SCL and QA60 bands are added at the end
+        if self.s2_type == 'l2a':
+            self.img_bands[data_name] = [band for band in bands_l2a if band not in ['SCL', 'QA60']] + ['SCL', 'QA60']
+        else:
+            self.img_bands[data_name] = [band for band in bands_l1c if band != 'QA60'] + ['QA60']
         logging.debug('\t Sentinel2 image loaded')
-        logging.debug(f"Time taken for {data_name}: {time.time() - start}")
         
 
 
@@ -242,39 +405,29 @@ class ee_set:
 
         '''
 
-        start = time.time()
+        cfg = self.cfg.sentinel1
+        data_name = cfg.name
         
-        img = (ee.ImageCollection('COPERNICUS/S1_GRD')
-                        .filterDate(self.start_date, self.end_date) # gets images in the specified date range
-                        .filterBounds(self.polygon) # gets images that have some overlap with the tile
-                        .filter(ee.Filter.contains('.geo', self.polygon.buffer(200))) # gets images containing the tile plus some buffer
-                        .map(lambda image: image.clip(self.polygon)) # crops to tile
-                        .filterMetadata('instrumentMode', 'equals', 'IW') # selects for the interferometric wide swath mode
-                        .map(lambda image: image.set('date_difference', image.date().difference(self.s2_date, 'day').abs())) # calculate days off from S2 image
-                        .sort('date_difference')) # sort in ascending order by days off
-
-
-        # getting the ascending and descending images
-        img_asc = img.filterMetadata('orbitProperties_pass', 'equals', 'ASCENDING').first()
-        img_desc = img.filterMetadata('orbitProperties_pass', 'equals', 'DESCENDING').first()
-
-
-
-        # selecting the bands
-        try:
-            bands_asc = img_asc.bandNames().getInfo()
-            if 'angle' in bands_asc:
-                bands_asc.remove('angle')
-        except ee.ee_exception.EEException:
+        # the id and band names of the image of both orbits, from the batch discovery or resolved in one request. They are None if there is no image for the orbit
+        if self.discovered is not None and 'S1' in self.discovered:
+            s1_meta = self.discovered['S1']
+        else:
+            s1_meta = self.resolve(s1_selection(self.polygon, self.s2_date, cfg.collection, self.start_date, self.end_date))
+        img_asc = ee.Image(s1_meta['asc']['id']).clip(self.polygon) if s1_meta['asc'] is not None else None
+        img_desc = ee.Image(s1_meta['desc']['id']).clip(self.polygon) if s1_meta['desc'] is not None else None
+        s1_bands = {orbit: list(meta['bands']) if meta is not None else None for orbit, meta in s1_meta.items()}
+        bands_asc = s1_bands['asc']
+        bands_desc = s1_bands['desc']
+        if bands_asc is None:
             logging.debug('\t No ascending image found')
             img_asc = None
-        try:
-            bands_desc = img_desc.bandNames().getInfo()
-            if 'angle' in bands_desc:
-                bands_desc.remove('angle')
-        except ee.ee_exception.EEException:
+        elif 'angle' in bands_asc:
+            bands_asc.remove('angle')
+        if bands_desc is None:
             logging.debug('\t No descending image found')
             img_desc = None
+        elif 'angle' in bands_desc:
+            bands_desc.remove('angle')
 
         # if angle bands are available, remove them
         img_asc = img_asc.select(bands_asc).float() if img_asc is not None else None
@@ -295,7 +448,6 @@ class ee_set:
         self.img_bands[data_name + '_desc'] = bands_desc if img_desc is not None else None
 
         logging.debug('\t Sentinel1 image loaded')
-        logging.debug(f"Time taken for {data_name}: {time.time() - start}")
 
 
 
@@ -303,7 +455,6 @@ class ee_set:
         '''
         This function gets the elevation data for the tile. The data usually consists of the elevation, we also compute the slope from the elevation data, and return both.
         '''
-        start = time.time()
         cfg = self.cfg.aster # getting the config for aster elevation data
         data_name = cfg.name # the name used to save the image in the image_set dictionary and the export name
         bands = list(cfg.BANDS) # the bands to be selected from the image
@@ -318,10 +469,9 @@ class ee_set:
         # self.image_set[data_name]['slope'] = slope
         merge = merge.resample('bilinear').reproject(self.proj)
         self.image_set[data_name] = merge
-        self.img_bands[data_name] = merge.bandNames().getInfo()
+        self.img_bands[data_name] = self.cached_band_names(('bands', cfg.collection, bands), merge)
     
         logging.debug('\t elevation and slope image loaded')
-        logging.debug(f"Time taken for {data_name}: {time.time() - start}")
 
 
     def era5(self):
@@ -330,7 +480,6 @@ class ee_set:
         temperature stats, the average temperature from 2018 - 2021 was roughly the same. We compute 3 sets of stats. 1 for the current month, 1 for the previous month, and 1 for the full year.
         '''
 
-        start = time.time()
 
         cfg = self.cfg.era5 # getting the config for era5
         data_name = cfg.name
@@ -394,14 +543,23 @@ class ee_set:
         # self.image_set[data_name]['month2'] = ERA5_month2
         # self.image_set[data_name]['year'] = ERA5_yearly_image
 
-        center_pixels = ERA5_combined.reduceRegion(
-            reducer=ee.Reducer.mean(),
-            geometry=self.polygon,
-            scale=10 
-        )
-        center_pixels = center_pixels.getInfo()
+        def compute():
+            return self.resolve({
+                'values': ERA5_combined.reduceRegion(
+                    reducer=ee.Reducer.mean(),
+                    geometry=self.polygon,
+                    scale=10 
+                ),
+                'band_names': ERA5_combined.bandNames(),
+            })
 
-        band_names = ERA5_combined.bandNames().getInfo()
+        # the values only depend on the month of the s2 image and on the ERA5 pixels covered by the tile. Hence all the tiles that fall in the same
+        # ERA5 pixel share the result for a month. Tiles that overlap more than one pixel are cached using their exact bounds.
+        cell = grid_cell(self.bounds, cfg.cell_size, cfg.cell_origin)
+        key = ('era5', cfg.collection, bands, self.s2_date[:7], cell if cell is not None else self.bounds)
+        result = get_cache().get_or_compute(key, compute)
+        center_pixels = result['values']
+        band_names = result['band_names']
 
         self.era5_data['month1'] = [center_pixels[band] for band in band_names[:4]]
         self.era5_data['month2'] = [center_pixels[band] for band in band_names[4:8]]
@@ -415,7 +573,6 @@ class ee_set:
 
 
         logging.debug('\t ERA5 image loaded')
-        logging.debug(f"Time taken for {data_name}: {time.time() - start}")
 
 
     def dynamic_world(self):
@@ -435,7 +592,6 @@ class ee_set:
 
         We choose the label band since that contains which of these labels were chosen.
         '''
-        start = time.time()
         cfg = self.cfg.dynamic_world
         data_name = cfg.name
         bands = list(cfg.BANDS)
@@ -473,27 +629,26 @@ class ee_set:
         dw_ic = dw_ic.map(reclasify)
         dw_image = dw_ic.mode().clip(self.polygon)
         
-        bands = dw_image.bandNames().getInfo()
+        bands = self.resolve({'bands': dw_image.bandNames()})['bands']
 
 
         if len(bands) == 0:
             logging.debug('\t No dynamic world image found')
             self.image_set[data_name] = None
         else:
+            # reprojecting does not change the bands
             dw_image = dw_image.reproject(self.proj)
             self.image_set[data_name] = dw_image
-            self.img_bands[data_name] = dw_image.bandNames().getInfo()
+            self.img_bands[data_name] = bands
             logging.debug('\t Dynamic world image loaded')
 
 
 
-        logging.debug(f"Time taken for {data_name}: {time.time() - start}")
 
     def canopy_height_eth(self):
         '''
         This function gets the ETH canopy height and standard deviation from the year 2020.
         '''
-        start = time.time()
         cfg = self.cfg.canopy_height_eth  # getting the config for canopy_height_eth
         data_name = cfg.name  # the name used to save the image in the image_set dictionary and the export name
         collections = list(cfg.COLLECTIONS)  # the collections with single bands that will be used
@@ -505,17 +660,15 @@ class ee_set:
         merge = merge.resample('bilinear').reproject(self.proj)
         merge = merge.rename(['height', 'std'])
         self.image_set[data_name] = merge
-        self.img_bands[data_name] = merge.bandNames().getInfo()
+        self.img_bands[data_name] = self.cached_band_names(('bands', collections), merge)
 
         logging.debug('\t ETH canopy height and std loaded')
-        logging.debug(f"Time taken for {data_name}: {time.time() - start}")
 
     def esa_worldcover(self):
         '''
         This function gets the esa worldcover data for the tile.
         '''
 
-        start = time.time()
         cfg = self.cfg.esa_worldcover  # getting the config for esa_worldcover
         data_name = cfg.name  # the name used to save the image in the image_set dictionary and the export name
         bands = list(cfg.BANDS)  # the bands to be selected from the image
@@ -525,10 +678,9 @@ class ee_set:
         dataset = dataset.reproject(self.proj)
 
         self.image_set[data_name] = dataset
-        self.img_bands[data_name] = dataset.bandNames().getInfo()
+        self.img_bands[data_name] = self.cached_band_names(('bands', cfg.collection, bands), dataset)
 
         logging.debug('\t esa worldcover loaded')
-        logging.debug(f"Time taken for {data_name}: {time.time() - start}")
 
         
 
@@ -556,6 +708,39 @@ class ee_set:
         logging.info(f"Exported all images for {self.id}")
 
     
+    def download_image(self, data_name, image, extra_info = None):
+        '''
+        Downloads one image as a GeoTIFF to {export_folder}/{data_name}/{id}.tif (or {id}_{extra_info}.tif). The file is streamed to a temporary file and
+        only renamed to the final path once it is complete, hence a failed download never leaves a truncated tif behind.
+        The band list is not passed to getDownloadUrl, since by default all the bands of the image are downloaded. This saves a request to GEE.
+        '''
+        name = f"{data_name}_{extra_info}_{self.id}" if extra_info is not None else f"{data_name}_{self.id}"
+        file_name = f"{self.id}_{extra_info}.tif" if extra_info is not None else f"{self.id}.tif"
+
+        with self.metrics.stage('url'):
+            url = ee_call(lambda: get_backend().download_url(image, {
+                'name': name,
+                'scale': 10,
+                'crs': self.crs,
+                'region': self.region,
+                'format': 'GeoTIFF',
+            }))
+
+        # the file is written while it is streamed, hence the transfer stage includes writing the file
+        with self.metrics.stage('transfer'), rate_limited_get(url, stream=True) as r:
+            if r.status_code >= 500:
+                # the session already retried this request, so we raise and let the @retry of the export function try again later
+                raise DownloadError(f"Error downloading {data_name}: status {r.status_code}")
+            if r.status_code != 200:
+                logging.debug(f"Error downloading {data_name} to local directory")
+                return False
+            size, checksum = stream_to_file(r, f"{self.export_folder}/{data_name}/{file_name}")
+        self.metrics.add_bytes('transfer', size)
+        self.downloaded[f"{data_name}/{file_name}"] = {'bytes': size, 'sha256': checksum}
+        logging.debug(f"Downloaded {data_name} to local directory")
+        return True
+
+
     @retry(tries=10, delay=1, backoff=2)
     def export_local(self, data_name, image):
         # data_name, image = args_list
@@ -564,49 +749,11 @@ class ee_set:
             for extra_info, img in image.items():
                 if img is None:
                     continue
-                start = time.time()
-                url = img.getDownloadUrl({
-                    'name': f"{data_name}_{extra_info}_{self.id}",
-                    'scale': 10,
-                    'crs': self.crs,
-                    'region': self.polygon.getInfo()['coordinates'],
-                    'format': 'GeoTIFF',
-                    'bands': img.bandNames().getInfo()
-                })  
-                logging.debug(f"time taken for getting url: {time.time() - start}")
-                
-                r = requests.get(url, stream=True, verify=False)
-                if r.status_code == 200:
-                    with open(f"{self.export_folder}/{data_name}/{self.id}_{extra_info}.tif", 'wb') as f:
-                        f.write(r.content)
-                    logging.debug(f"Downloaded {data_name} to local directory")
-                else:
-                    logging.debug(f"Error downloading {data_name} to local directory")
+                self.download_image(data_name, img, extra_info)
             return
         if image is None:
             return
-        start = time.time()
-        url = image.getDownloadUrl({
-            'name': f"{data_name}_{self.id}",
-            'scale': 10,
-            'crs': self.crs,
-            'region': self.polygon.getInfo()['coordinates'],
-            'format': 'GeoTIFF',
-            'bands': image.bandNames().getInfo()
-        })
-        logging.debug(f"time taken for getting url: {time.time() - start}")
-
-
-        r = requests.get(url, stream=True, verify=False)
-  
-
-        if r.status_code == 200:
-            with open(f"{self.export_folder}/{data_name}/{self.id}.tif", 'wb') as f:
-                f.write(r.content)
-            logging.debug(f"Downloaded {data_name} to local directory")
-        else:
-            logging.debug(f"Error downloading {data_name} to local directory")
-            return
+        self.download_image(data_name, image)
         
     @retry(tries=10, delay=1, backoff=2)
     def export_local_single(self):
@@ -616,51 +763,11 @@ class ee_set:
                 for extra_info, img in image.items():
                     if img is None:
                         continue
-                    start = time.time()
-                    url = img.getDownloadUrl({
-                        'name': f"{data_name}_{extra_info}_{self.id}",
-                        'scale': 10,
-                        'crs': self.crs,
-                        'region': self.polygon.getInfo()['coordinates'],
-                        'format': 'GeoTIFF',
-                        'bands': img.bandNames().getInfo()
-                    })  
-                    logging.debug(f"time taken for getting url: {time.time() - start}")
-                    start = time.time()
-                    r = requests.get(url, stream=True, verify=False)
-                    if r.status_code == 200:
-                        with open(f"{self.export_folder}/{data_name}/{self.id}_{extra_info}.tif", 'wb') as f:
-                            f.write(r.content)
-                        logging.debug(f"Downloaded {data_name} to local directory")
-                        logging.debug(f"time taken for downloading: {time.time() - start}")
-
-                    else:
-                        logging.debug(f"Error downloading {data_name} to local directory")
-                return
+                    self.download_image(data_name, img, extra_info)
+                continue
             if image is None:
-                return
-            start = time.time()
-            url = image.getDownloadUrl({
-                'name': f"{data_name}_{self.id}",
-                'scale': 10,
-                'crs': self.crs,
-                'region': self.polygon.getInfo()['coordinates'],
-                'format': 'GeoTIFF',
-                'bands': image.bandNames().getInfo()
-            })
-            logging.debug(f"time taken for getting url: {time.time() - start}")
-            start = time.time()
-            r = requests.get(url, stream=True, verify=False)
-    
-
-            if r.status_code == 200:
-                with open(f"{self.export_folder}/{data_name}/{self.id}.tif", 'wb') as f:
-                    f.write(r.content)
-                logging.debug(f"Downloaded {data_name} to local directory")
-                logging.debug(f"time taken for downloading: {time.time() - start}")
-            else:
-                logging.debug(f"Error downloading {data_name} to local directory")
-                return
+                continue
+            self.download_image(data_name, image)
 
                 
     def export(self):
@@ -678,7 +785,7 @@ class ee_set:
                         description = f"{data_name}_{extra_info}_{self.id}",
                         bucket = self.cfg.bucket,
                         fileNamePrefix = self.export_folder + '/' + data_name + '/' + self.id + '_' + extra_info ,
-                        region = self.polygon.getInfo()['coordinates'],
+                        region = self.region,
                         scale = 10,
                         crs = self.crs,
                         maxPixels = 1e13
@@ -692,7 +799,7 @@ class ee_set:
                 description = f"{data_name}_{self.id}",
                 bucket = self.cfg.bucket,
                 fileNamePrefix = self.export_folder + '/' + data_name + '/' + self.id,
-                region = self.polygon.getInfo()['coordinates'],
+                region = self.region,
                 scale = 10,
                 crs = self.crs,
                 maxPixels = 1e13
@@ -704,245 +811,50 @@ class ee_set:
 
 
     @retry(tries=10, delay=1, backoff=2)           
-    def download_and_process_image(self, image, crs):
-        url = image.getDownloadUrl({
-            'bands': image.bandNames().getInfo(),
-            'region': self.polygon.getInfo()['coordinates'],
-            'scale': 10,
-            'format': 'NPY'})
-        r = requests.get(url)
-        np_geotiff = np.load(io.BytesIO(r.content))
-
-        # np_geotiff = np.load(io.BytesIO(geotiff))
-        # cropping the image to 128x128
-        new_shape = (128, 128)
+    def download_and_process_image(self, image):
+        '''
+        Downloads one image as an NPY structured array, and returns it as an (H, W, C) float32 array center cropped to cfg.image_size, along with the band names.
+        The layout is the same as the one returned by tifffile for the GeoTIFF exports, so the converter reads both in the same way.
+        '''
+        with self.metrics.stage('url'):
+            url = ee_call(lambda: get_backend().download_url(image, {
+                'region': self.region,
+                'scale': 10,
+                'crs': self.crs,
+                'format': 'NPY'}))
+        with self.metrics.stage('transfer'), rate_limited_get(url) as r:
+            if r.status_code != 200:
+                raise DownloadError(f"Error downloading the pixels for {self.id}: status {r.status_code}")
+            content = r.content
+        self.metrics.add_bytes('transfer', len(content))
+        np_geotiff = np.load(io.BytesIO(content))
+
+        # cropping the image to image_size x image_size
+        img_size = self.cfg.image_size
         old_shape = np_geotiff.shape
-        start_x = (old_shape[0] - new_shape[0]) // 2
-        start_y = (old_shape[1] - new_shape[1]) // 2
-        np_geotiff = np_geotiff[start_x:start_x + new_shape[0], start_y:start_y + new_shape[1]]
+        start_x = max((old_shape[0] - img_size) // 2, 0)
+        start_y = max((old_shape[1] - img_size) // 2, 0)
+        np_geotiff = np_geotiff[start_x:start_x + img_size, start_y:start_y + img_size]
 
-        arr = rfn.structured_to_unstructured(np_geotiff[list(np_geotiff.dtype.names)])
-        arr = arr.transpose(2, 0, 1)
-        return arr, np_geotiff.dtype.names
+        arr = rfn.structured_to_unstructured(np_geotiff[list(np_geotiff.dtype.names)]).astype(np.float32)
+        return arr, list(np_geotiff.dtype.names)
 
     def export_pixels(self):
         '''
-        This function exports to the local directory using the computePixels functions.  With this code, I am trying to store the np arrays directly into an HDF5 file.
+        This function exports to the local directory without going through GeoTIFF files. Each image is downloaded as an NPY array, cropped, and written
+        straight into the array store ({export_folder}/{data_name}/{shard}/{id}.npy), see utils/array_store.py.
         '''
-
-        # Initialize dictionaries and arrays
-        self.return_dict = {}
-
         for data_name, image in self.image_set.items():
             if isinstance(image, dict):
-                if data_name == 'sentinel1':
-                    arr = np.full((8, 128, 128), np.nan)
-                elif data_name == 'era5':
-                    arr = np.full((12, 128, 128), np.nan)
-                    c = 0
-
                 for extra_info, img in image.items():
                     if img is None:
                         continue
-                    arr_t, bands_downloaded = self.download_and_process_image(img, self.crs)
-                    if data_name == 'sentinel1':
-                        if extra_info == 'asc':
-                            if 'VV' in bands_downloaded:
-                                arr[0] = arr_t[bands_downloaded.index('VV')]
-                            if 'VH' in bands_downloaded:
-                                arr[1] = arr_t[bands_downloaded.index('VH')]
-                            if 'HH' in bands_downloaded:
-                                arr[2] = arr_t[bands_downloaded.index('HH')]
-                            if 'HV' in bands_downloaded:
-                                arr[3] = arr_t[bands_downloaded.index('HV')]
-                        elif extra_info == 'desc':
-                            if 'VV' in bands_downloaded:
-                                arr[4] = arr_t[bands_downloaded.index('VV')]
-                            if 'VH' in bands_downloaded:
-                                arr[5] = arr_t[bands_downloaded.index('VH')]
-                            if 'HH' in bands_downloaded:
-                                arr[6] = arr_t[bands_downloaded.index('HH')]
-                            if 'HV' in bands_downloaded:
-                                arr[7] = arr_t[bands_downloaded.index('HV')]
-
-                    if data_name == 'era5':
-                        arr[c:c+4] = arr_t
-                        c += 4
-                self.return_dict[data_name] = arr
-            else:
-                arr, bands_downloaded = self.download_and_process_image(image, self.crs)
-                self.return_dict[data_name] = arr
-
-
-
-    
-
-
-    # def export_pixels(self):
-    #     '''
-    #     This function also exports to the local directory. It is good for small files, and holds band information. With this code, i am trying to store the np arrays directly into a hdf5 file.
-        
-    #     '''
-
-
-    #     for data_name, image in self.image_set.items():
-    #         if isinstance(image, dict):
-    #             if data_name == 'sentinel1':
-    #                 arr = np.full((8, 128, 128), np.nan)
-    #             elif data_name == 'era5':
-    #                 arr = np.full((12, 128, 128), np.nan)
-    #                 c = 0
-                
-    #             for extra_info, img in image.items():
-    #                 if img is None:
-    #                     continue
-    #                 img = img.resample('bicubic').reproject(crs=self.crs, scale=10)
-    #                 proj = ee.Projection(self.crs).atScale(10).getInfo()
-
-    #                 request = {
-    #                     'expression': image,
-    #                     'fileFormat': 'NPY',
-    #                     'grid': {
-    #                         'affineTransform': {
-    #                             'scaleX': 10,
-    #                             'shearX': 0,
-    #                             'shearY': 0,
-    #                             'scaleY': -10,
-    #                         },
-    #                         'crsCode': proj['crs'],
-    #                     },
-
-    #                 }
-    #                 REQUEST = dict(request)
-    #                 geotiff = ee.data.computePixels(REQUEST)
-    #                 np_geotiff = np.load(io.BytesIO(geotiff))
-                    
-    #                 # cropping the image to 128x128
-    #                 new_shape = (128, 128)
-    #                 old_shape = np_geotiff.shape
-    #                 start_x = (old_shape[0] - new_shape[0]) // 2
-    #                 start_y = (old_shape[1] - new_shape[1]) // 2
-    #                 np_geotiff = np_geotiff[start_x:start_x + new_shape[0], start_y:start_y + new_shape[1]]
-
-    #                 arr_t = np_geotiff.view(np.float32).reshape((-1,) + np_geotiff.shape)
-    #                 if data_name == 'sentinel1':
-    #                     bands = np_geotiff.dtype.names
-
-    #                     if extra_info == 'asc':
-    #                         # put the bands in the correct order [VV, VH, HH, HV], if they are present
-    #                         if 'VV' in bands:
-    #                             arr[0] = arr_t['VV']
-    #                         if 'VH' in bands:
-    #                             arr[1] = arr_t['VH']
-    #                         if 'HH' in bands:
-    #                             arr[2] = arr_t['HH']
-    #                         if 'HV' in bands:
-    #                             arr[3] = arr_t['HV']
-    #                     elif extra_info == 'desc':
-    #                         if 'VV' in bands:
-    #                             arr[4] = arr_t['VV']
-    #                         if 'VH' in bands:
-    #                             arr[5] = arr_t['VH']
-    #                         if 'HH' in bands:
-    #                             arr[6] = arr_t['HH']
-    #                         if 'HV' in bands:
-    #                             arr[7] = arr_t['HV']
-    #                 if data_name == 'era5':
-    #                     arr[c:c+4] = arr_t
-    #                     c += 4
-
-    #             self.return_dict[data_name] = arr
-
-
-    #         image = image.resample('bicubic').reproject(crs=self.crs, scale=10)
-    #         proj = ee.Projection(self.crs).atScale(10).getInfo()
-
-    #         request = {
-    #             'expression': image,
-    #             'fileFormat': 'NPY',
-    #             'grid': {
-    #                 'affineTransform': {
-    #                     'scaleX': 10,
-    #                     'shearX': 0,
-    #                     'shearY': 0,
-    #                     'scaleY': -10,
-    #                 },
-    #                 'crsCode': proj['crs'],
-    #             },
-
-    #         }
-
-    #         REQUEST = dict(request)
-    #         geotiff = ee.data.computePixels(REQUEST)
-    #         np_geotiff = np.load(io.BytesIO(geotiff))
-            
-    #         # cropping the image to 128x128
-    #         new_shape = (128, 128)
-    #         old_shape = np_geotiff.shape
-    #         start_x = (old_shape[0] - new_shape[0]) // 2
-    #         start_y = (old_shape[1] - new_shape[1]) // 2
-    #         np_geotiff = np_geotiff[start_x:start_x + new_shape[0], start_y:start_y + new_shape[1]]
-
-    #         arr = np_geotiff.view(np.float32).reshape((-1,) + np_geotiff.shape)                
-    #         # display_array = rfn.structured_to_unstructured(np_geotiff[['B4', 'B3', 'B2']])/10000
-    #         # plt.imshow(display_array)
-    #         # plt.show()
-    #         self.return_dict[data_name] = arr
-
-
-    #         exit()
-    #         # writing the np to geoTIFF
-    #         from osgeo import gdal
-    #         import pyproj
-    #         from osgeo import osr
-
-    #         upp_left_coords = self.polygon.bounds().coordinates().get(0).getInfo()[3]
-
-    #         source_proj = pyproj.Proj(proj='latlong', datum='WGS84')
-    #         target_proj = pyproj.Proj(init=proj['crs'])
-
-    #         print(upp_left_coords)
-    #         print(proj['crs'])
-
-    #         upp_left_x, upp_left_y = pyproj.transform(source_proj, target_proj, upp_left_coords[0], upp_left_coords[1])
-    #         tranform_var = (upp_left_x, 10, 0, upp_left_y, 0, -10)
-    #         driver = gdal.GetDriverByName('GTiff')
-    #         GDT_dtype = gdal.GDT_Float32
-    #         rows, cols = np_geotiff.shape[0], np_geotiff.shape[1]
-    #         band_num = len(np_geotiff.dtype.names)
-    #         outRaster = driver.Create('/Users/qbk152/Desktop/codes/global-LR/gdal-test.tif', cols, rows, band_num, GDT_dtype)
-
-    #         outRaster.SetGeoTransform(tranform_var)
-    #         for b in range(band_num):
-    #             outband = outRaster.GetRasterBand(b + 1)
-    #             outband.WriteArray(np_geotiff[np_geotiff.dtype.names[b]])
-            
-
-    #         outRasterSRS = osr.SpatialReference()
-    #         outRasterSRS.ImportFromEPSG(int(proj['crs'].split(':')[1]))
-    #         outRaster.SetProjection(outRasterSRS.ExportToWkt())
-
-    #         outband.FlushCache()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-    
-
-
-
-
-
-
+                    arr, _ = self.download_and_process_image(img)
+                    with self.metrics.stage('write'):
+                        write_array(shard_path(self.export_folder, data_name, f"{self.id}_{extra_info}"), arr)
+                continue
+            if image is None:
+                continue
+            arr, _ = self.download_and_process_image(image)
+            with self.metrics.stage('write'):
+                write_array(shard_path(self.export_folder, data_name, self.id), arr)
@@ -0,0 +1,97 @@
+'''
+Batch discovery of the sentinel2 and sentinel1 images of the tiles. Instead of selecting the images tile by tile in ee_set (one request per tile and
+dataset), a chunk of tiles is sent as an ee.FeatureCollection, the selection of ee_data.s2_selection and ee_data.s1_selection is mapped over it server
+side, and the results of the whole chunk are fetched in one request.
+
+The results are written to a discovery file, a precursor of the tile_info with one JSON line per tile:
+    {tile_id: {'S2_type', 'NO_DATA', 'S2_IMAGEID', 'S2_DATE', 'S2_BANDS', 'CRS', 'S1': {'asc': {'id', 'bands'} or None, 'desc': ...}}}
+ee_set then loads the images from these ids without any further request to select them. The random choices of a tile (year, l2a or l1c, seed of the
+selection) are drawn from the seed of the tile in the same way as ee_set, so a tile gets the same images with or without the discovery.
+'''
+
+import logging
+import os
+import random
+from ee_utils.backend import ee
+from ee_utils.ee_data import resolve, s2_sampling, s2_selection, s1_selection, START_DATE, END_DATE
+from utils.geometry import centroid, tile_seed
+from utils.parallel import imap_ordered
+from utils.utils import read_tile_info, append_tile_info
+
+
+def discover_chunk(tiles, cfg, cld_threshold = 10):
+    '''
+    Selects the images of a chunk of tiles in one request. Returns a dictionary {tile_id: record} in the format of the discovery file.
+    '''
+    # use_l2a decides which collections are searched, so it has to be known client side. The tiles are split in two feature collections
+    groups = {True: [], False: []}
+    for tile in tiles:
+        coordinates = tile['geometry']['coordinates']
+        lon, lat = centroid(coordinates)
+        s_date, e_date, use_l2a, selection_seed = s2_sampling(random.Random(tile_seed(lat, lon)))
+        groups[use_l2a].append(ee.Feature(ee.Geometry.Polygon(coordinates), {
+            'tile_id': tile['properties']['tile_id'],
+            's_date': s_date,
+            'e_date': e_date,
+            'seed': selection_seed,
+        }))
+
+    with_s1 = 'sentinel1' in cfg.datasets
+
+    def selector(use_l2a):
+        def select(feature):
+            polygon = feature.geometry()
+            selection = s2_selection(polygon, feature.get('s_date'), feature.get('e_date'), use_l2a, feature.get('seed'), cfg.sentinel2, cld_threshold)
+            result = {'tile_id': feature.get('tile_id'), 's2': selection}
+            if with_s1:
+                image = selection.get('image')
+                result['s1'] = ee.Algorithms.If(
+                    image,
+                    s1_selection(polygon, ee.Dictionary(image).get('date'), cfg.sentinel1.collection, START_DATE, END_DATE),
+                    None
+                )
+            return feature.set('result', ee.Dictionary(result))
+        return select
+
+    values = {}
+    for use_l2a, features in groups.items():
+        if len(features) > 0:
+            values['l2a' if use_l2a else 'l1c'] = ee.FeatureCollection(features).map(selector(use_l2a)).aggregate_array('result')
+    results = resolve(values)
+
+    discovered = {}
+    for result in [result for group in results.values() for result in group]:
+        image = result['s2']['image']
+        record = {'S2_type': result['s2']['type'], 'NO_DATA': image is None}
+        if image is not None:
+            record.update({'S2_IMAGEID': image['id'], 'S2_DATE': image['date'], 'S2_BANDS': image['bands'], 'CRS': image['crs']})
+            if with_s1:
+                record['S1'] = result['s1']
+        discovered[result['tile_id']] = record
+    return discovered
+
+
+def discover_range(tiles, path, cfg):
+    '''
+    Discovers the images of the given tiles and appends them to the discovery file at path. Tiles that are already in the file are not discovered again.
+    The chunks are sent by cfg.num_workers threads at the same time. If a chunk fails, its tiles are left out, and ee_set selects their images itself.
+    Returns a dictionary {tile_id: record} with all the tiles of the file.
+    '''
+    discovered = read_tile_info(path) if os.path.exists(path) else {}
+    missing = [tile for tile in tiles if tile['properties']['tile_id'] not in discovered]
+    chunk_size = cfg.discovery.chunk_size
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+
+    def discover(chunk):
+        try:
+            return discover_chunk(chunk, cfg)
+        except Exception as e:
+            logging.error(f"Discovery of {len(chunk)} tiles failed: {e}")
+            return {}
+
+    for chunk, records in imap_ordered(discover, chunks, cfg.num_workers):
+        for tile_id, record in records.items():
+            append_tile_info(path, tile_id, record)
+        discovered.update(records)
+    logging.info(f"Discovery: {len(missing)} tiles discovered in {len(chunks)} requests, {len(discovered)} tiles in {path}")
+    return discovered
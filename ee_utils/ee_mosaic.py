@@ -0,0 +1,170 @@
+'''
+Mosaic download of the static datasets (aster, canopy_height_eth, esa_worldcover). These datasets do not depend on the date of the tile, so the tiles
+that share a CRS and are close to each other can be downloaded as one larger image, and each tile is then sliced out locally. This replaces one
+getDownloadUrl and one small transfer per tile by one request and one large transfer per group of tiles.
+
+The tiles are grouped by CRS (from the tile_info) and by a lon/lat cell of mosaic.cell_size degrees. The mosaic is downloaded on the 10 m grid of
+the CRS, the same grid as the per tile downloads, and each tile is the image_size x image_size window around its center. This is the same as the
+center crop of export_mode: pixels, and the tiles are written in the same place ({export_folder}/extra/{shard}/{tile_id}.npy).
+Unlike the per tile download, the slope of aster is computed from the elevation around the tile instead of the elevation clipped to the tile, so
+the pixels at the border of a tile can differ slightly.
+'''
+
+import io
+import logging
+import math
+import numpy as np
+from numpy.lib import recfunctions as rfn
+from retry import retry
+
+from ee_utils.backend import ee, get_backend
+from ee_utils.ee_data import ee_call, resolve
+from utils.array_store import shard_path, write_array
+from utils.cache import get_cache
+from utils.download import rate_limited_get, DownloadError
+from utils.geometry import centroid
+from utils.ledger import DOWNLOADED, FAILED, NO_DATA
+from utils.modalities import DATASETS
+from utils.parallel import imap_ordered
+
+
+SCALE = 10 # the export scale in meters
+
+
+def static_image(name, cfg):
+    '''
+    Returns the image of a static dataset, built as in the corresponding ee_set function but without clipping it to a tile, and the key of its band
+    names in the cache (the same key as in ee_set, so the band names are shared).
+    '''
+    if name == 'aster':
+        bands = list(cfg.aster.BANDS)
+        elevation = ee.Image(cfg.aster.collection).select(bands).float()
+        image = ee.Image.cat([elevation, ee.Terrain.slope(elevation)]).resample('bilinear')
+        return image, ('bands', cfg.aster.collection, bands)
+    if name == 'canopy_height_eth':
+        collections = list(cfg.canopy_height_eth.COLLECTIONS)
+        image = ee.Image.cat([ee.Image(collections[0]).float(), ee.Image(collections[1]).float()]).resample('bilinear').rename(['height', 'std'])
+        return image, ('bands', collections)
+    if name == 'esa_worldcover':
+        bands = list(cfg.esa_worldcover.BANDS)
+        image = ee.ImageCollection(cfg.esa_worldcover.collection).first().select(bands)
+        return image, ('bands', cfg.esa_worldcover.collection, bands)
+    raise ValueError(f"{name} is not a static dataset")
+
+
+def can_use_mosaic(cfg, tile_info):
+    '''
+    The mosaic download is used if it is enabled, the tiles are exported as arrays (export_mode: pixels), the CRS of the tiles is known (tile_info),
+    and all the datasets are static.
+    '''
+    return cfg.mosaic.enabled and cfg.export_mode == 'pixels' and tile_info is not None and all(DATASETS.get(name, {}).get('static', False) for name in cfg.datasets)
+
+
+def group_tiles(tiles, tile_info, cell_size):
+    '''
+    Groups the tiles by CRS and by a lon/lat cell of cell_size degrees. Returns a list of (crs, tiles), in the order of the first tile of each group.
+    '''
+    groups = {}
+    for tile in tiles:
+        id = tile['properties']['tile_id']
+        if id not in tile_info or tile_info[id].get('NO_DATA', False):
+            continue
+        lon, lat = centroid(tile['geometry']['coordinates'])
+        key = (tile_info[id]['CRS'], math.floor(lon / cell_size), math.floor(lat / cell_size))
+        groups.setdefault(key, []).append(tile)
+    return [(key[0], group) for key, group in groups.items()]
+
+
+def project_centers(tiles, crs):
+    '''
+    Returns the centers of the tiles in the coordinates of the CRS, in one request.
+    '''
+    points = [ee.Geometry.Point(list(centroid(tile['geometry']['coordinates']))).transform(crs, 0.01).coordinates() for tile in tiles]
+    return resolve({'centers': ee.List(points)})['centers']
+
+
+@retry(tries=10, delay=1, backoff=2)
+def download_mosaic(image, crs, x0, y0, width, height):
+    '''
+    Downloads the image on the grid of the CRS with the top left corner (x0, y0), as an (height, width, C) float32 array.
+    '''
+    url = ee_call(lambda: get_backend().download_url(image, {
+        'crs': crs,
+        'crs_transform': [SCALE, 0, x0, 0, -SCALE, y0],
+        'dimensions': f"{width}x{height}",
+        'format': 'NPY'}))
+    with rate_limited_get(url) as r:
+        if r.status_code != 200:
+            raise DownloadError(f"Error downloading a mosaic in {crs}: status {r.status_code}")
+        mosaic = np.load(io.BytesIO(r.content))
+    return rfn.structured_to_unstructured(mosaic[list(mosaic.dtype.names)]).astype(np.float32)
+
+
+def download_group(crs, tiles, image, cfg):
+    '''
+    Downloads the mosaic of a group of tiles and writes the window of each tile to the array store. Returns the ids of the tiles that were written.
+    '''
+    size = cfg.image_size
+    half = size * SCALE / 2
+    centers = project_centers(tiles, crs)
+    xs = [center[0] for center in centers]
+    ys = [center[1] for center in centers]
+    # the corner is snapped to the 10 m grid of the CRS, so the pixels are the same as the ones of the per tile download
+    x0 = math.floor((min(xs) - half) / SCALE) * SCALE
+    y0 = math.ceil((max(ys) + half) / SCALE) * SCALE
+    width = math.ceil((max(xs) + half - x0) / SCALE)
+    height = math.ceil((y0 - min(ys) + half) / SCALE)
+    mosaic = download_mosaic(image, crs, x0, y0, width, height)
+
+    written = []
+    for tile, (x, y) in zip(tiles, centers):
+        col = int((x - x0) // SCALE) - size // 2
+        row = int((y0 - y) // SCALE) - size // 2
+        arr = mosaic[max(row, 0):row + size, max(col, 0):col + size]
+        write_array(shard_path(cfg.export_folder, 'extra', tile['properties']['tile_id']), arr)
+        written.append(tile['properties']['tile_id'])
+    logging.debug(f"Mosaic of {len(tiles)} tiles in {crs}: {width}x{height} pixels")
+    return written
+
+
+def download_mosaics(tiles, tile_info, cfg):
+    '''
+    Downloads the static datasets of the given tiles with one mosaic per group of nearby tiles, cfg.num_workers groups at the same time.
+    Yields (tile_id, bands, state) for every tile, where bands is the dictionary of the bands of each dataset, or None if the tile was not downloaded,
+    and state is the ledger state of the tile: downloaded, failed (the group of the tile failed), no_data (no sentinel2 image), or None for the tiles
+    that are not in tile_info, which are skipped like in ee_set.
+    '''
+    images = []
+    bands = {}
+    for name in cfg.datasets:
+        image, key = static_image(name, cfg)
+        images.append(image)
+        bands[cfg[name].name] = get_cache().get_or_compute(key, lambda: resolve({'bands': image.bandNames()})['bands'])
+    # the datasets are merged in the order of the config, like the merged image of ee_set
+    image = ee.Image.cat(images)
+
+    groups = group_tiles(tiles, tile_info, cfg.mosaic.cell_size)
+    logging.info(f"Mosaic: {len(tiles)} tiles in {len(groups)} groups")
+
+    # the tiles left out of the groups are yielded first, so that every tile is counted and recorded in the ledger
+    for tile in tiles:
+        id = tile['properties']['tile_id']
+        if id not in tile_info:
+            logging.info(f"Tile {id} not in tile_info. Skipping")
+            yield id, None, None
+        elif tile_info[id].get('NO_DATA', False):
+            yield id, None, NO_DATA
+
+    def download(group):
+        crs, members = group
+        try:
+            return download_group(crs, members, image, cfg)
+        except Exception as e:
+            logging.error(f"Mosaic of {len(members)} tiles in {crs} failed: {e}")
+            return []
+
+    for (crs, members), written in imap_ordered(download, groups, cfg.num_workers):
+        written = set(written)
+        for tile in members:
+            id = tile['properties']['tile_id']
+            yield (id, bands, DOWNLOADED) if id in written else (id, None, FAILED)
@@ -5,17 +5,25 @@ The main function to download all the data from GEE
 
 
 import os
-import config.ee_init 
-import ee
-import numpy as np
-import geojson
 import hydra
 from omegaconf import DictConfig, OmegaConf
 
+from ee_utils.backend import configure_backend
 from ee_utils.ee_data import ee_set
-from utils.utils import read_geojson, update_tile_info
+from ee_utils.ee_discovery import discover_range
+from ee_utils.ee_mosaic import can_use_mosaic, download_mosaics
+from utils.utils import read_geojson, update_tile_info, append_tile_info, compact_tile_info
+from utils.parallel import imap_ordered
+from utils.download import configure_session
+from utils.cache import configure_cache, get_cache
+from ee_utils.ee_async import configure_ee_concurrency
+from utils.rate_limiter import configure_rate_limiter, rate_limiter_stats
+from utils.ledger import Ledger, PENDING, FAILED
+from utils.work_queue import WorkQueue, LeaseLost
+from utils.tile_index import open_tile_index
+from utils.metrics import get_metrics, append_metrics, write_prometheus
 import logging
-import h5py
+import socket
 import time
 import warnings
 import json
@@ -24,6 +32,117 @@ warnings.filterwarnings("ignore")
 
 
 
+def download_tile(tile, cfg, tile_info = None, ledger = None, discovered = None):
+    '''
+    Downloads all the datasets for a single tile. Returns the ee_set object, or None if the tile was skipped or failed. 
+    Any error is caught here, so that one bad tile does not stop the other tiles that are downloaded at the same time.
+    discovered is the record of the tile in the discovery file, if its images were already selected (see ee_utils/ee_discovery.py).
+    '''
+    id = tile['properties']['tile_id']
+    if tile_info is not None and id not in tile_info.keys():
+        # this is not in tile info, hence the s2 has not been downloaded yet. so we skip this tile
+        logging.info(f"Tile {id} not in tile_info. Skipping")
+        return None
+
+    if ledger is not None:
+        ledger.mark(id, cfg.datasets, PENDING)
+
+    start = time.time()
+    try:
+        # creating the ee_set object, the function calls are inside the constructor, hence it will automatically download the data
+        ee_set_ = ee_set(tile, cfg, tile_info=tile_info[id] if tile_info is not None else None, discovered=discovered)
+    except Exception as e:
+        logging.error(f"Tile {id} failed: {e}")
+        return None
+    ee_set_.metrics.add_time('total', time.time() - start)
+    return ee_set_
+
+
+
+def download_range(tiles, range_start, range_end, cfg, tile_info = None, ledger = None, on_tile = None):
+    '''
+    Downloads the given tiles, which are the tiles [range_start, range_end) of the geojson, and appends their information to tile_info_{range_start}_{range_end}.jsonl.
+    on_tile is called after every tile, e.g. to renew the lease of a batch in the work queue, and an exception raised by on_tile stops the range.
+    Returns the number of tiles that were processed.
+    '''
+    datasets = cfg.datasets
+
+    # the tile information is appended to a JSON Lines file, one line per tile
+    tile_info_file = f"{cfg.tile_info_path}/tile_info_{range_start}_{range_end}.jsonl"
+    num_appended = 0
+    # the time spent in each stage of each tile, one line per tile
+    metrics_file = f"{cfg.metrics_path}/metrics_{range_start}_{range_end}.jsonl" if cfg.metrics_path is not None else None
+    if os.path.exists(tile_info_file):
+        # a previous run of this range may have been killed while writing a line, compacting drops that line before we append to the file
+        compact_tile_info(tile_info_file)
+
+    if ledger is not None:
+        # resume works per tile: all the datasets of a tile are exported in one merged image, hence a tile with any dataset that is not done is
+        # downloaded again with all its datasets
+        completed = ledger.completed(datasets, [tile['properties']['tile_id'] for tile in tiles])
+        num_total = len(tiles)
+        tiles = [tile for tile in tiles if tile['properties']['tile_id'] not in completed]
+        logging.info(f"Ledger: {num_total - len(tiles)} tiles already complete, {len(tiles)} tiles remaining")
+
+    # the sentinel2 and sentinel1 images of the range are selected in a few large requests before downloading the tiles
+    discovered = {}
+    if cfg.discovery.enabled and tile_info is None and 'sentinel2' in datasets and len(tiles) > 0:
+        discovered = discover_range(tiles, f"{cfg.tile_info_path}/discovery_{range_start}_{range_end}.jsonl", cfg)
+
+    # the static datasets of nearby tiles are downloaded as one mosaic per group of tiles instead of one download per tile
+    if can_use_mosaic(cfg, tile_info) and len(tiles) > 0:
+        for i, (id, bands, state) in enumerate(download_mosaics(tiles, tile_info, cfg)):
+            logging.info(f'####################### Processed tile {id} [{i + 1}/{len(tiles)}] #######################')
+            if on_tile is not None:
+                on_tile()
+            if bands is not None and cfg.update_geojson:
+                tile_info[id]['BANDS'] = tile_info[id]['BANDS'] | bands
+                append_tile_info(tile_info_file, id, tile_info[id])
+            if ledger is not None and state is not None:
+                ledger.mark(id, datasets, state)
+        if os.path.exists(tile_info_file):
+            logging.info(f"Number of tiles in {tile_info_file}: {compact_tile_info(tile_info_file)}")
+        return len(tiles)
+
+    def download(tile):
+        return download_tile(tile, cfg, tile_info, ledger, discovered.get(tile['properties']['tile_id']))
+
+    # the tiles are downloaded concurrently by cfg.num_workers threads, but the results are handled in the same order as the geojson
+    for i, (tile, ee_set_) in enumerate(imap_ordered(download, tiles, cfg.num_workers)):
+        id = tile['properties']['tile_id']
+        logging.info(f'####################### Processed tile {id} [{i + 1}/{len(tiles)}] #######################')
+        if on_tile is not None:
+            on_tile()
+        if ee_set_ is None:
+            if ledger is not None and (tile_info is None or id in tile_info):
+                ledger.mark(id, datasets, FAILED)
+            continue
+        metrics = get_metrics().observe_tile(ee_set_.metrics)
+        if metrics_file is not None:
+            append_metrics(metrics_file, metrics)
+        if cfg.update_geojson and not ee_set_.no_data:
+            append_tile_info(tile_info_file, id, update_tile_info(tile, ee_set_, tile_info[id] if tile_info is not None else None))
+            num_appended += 1
+            if cfg.tile_info_compact_every > 0 and num_appended % cfg.tile_info_compact_every == 0:
+                compact_tile_info(tile_info_file)
+        elif ee_set_.failed:
+            logging.error(f"Tile {id} failed, it is downloaded again on the next run")
+        elif ee_set_.no_data:
+            logging.info(f"no sentinel2 data for tile {id}. Skipping")
+
+        if ledger is not None:
+            # the state of each dataset, e.g. sentinel1 is no_data if the tile has no sentinel1 image while the other datasets are downloaded
+            ledger.mark_states(id, {name: ee_set_.states.get(name, FAILED) for name in datasets})
+
+    if os.path.exists(tile_info_file):
+        logging.info(f"Number of tiles in {tile_info_file}: {compact_tile_info(tile_info_file)}")
+    # the current rates and the number of throttled requests so far, to see how close we are to the GEE quota
+    for stats in rate_limiter_stats():
+        logging.info(f"Rate limiter: {stats}")
+    return len(tiles)
+
+
+
 @hydra.main(config_path='config', config_name='config_data')
 def main(cfg: DictConfig) -> None:
     print(OmegaConf.to_yaml(cfg))
@@ -40,8 +159,21 @@ def main(cfg: DictConfig) -> None:
                         filemode='w'
         )
 
-    # reading the geojson file
-    gj = read_geojson(cfg.tiles_path)
+    # all the downloads of this process share one http session
+    configure_session(pool_size=cfg.http.pool_size, retries=cfg.http.retries, backoff=cfg.http.backoff)
+    configure_cache(max_size=cfg.cache.max_size, path=cfg.cache.path)
+    configure_ee_concurrency(cfg.ee_max_concurrent_requests)
+    # after configure_session, since the fake backend serves its downloads through the session
+    configure_backend(cfg.backend)
+    limits = cfg.rate_limit
+    for name, rate in [('ee', limits.ee_rate), ('download', limits.download_rate)]:
+        configure_rate_limiter(name, rate=rate, min_rate=limits.min_rate, max_rate=limits.max_rate, max_retries=limits.max_retries, backoff=limits.backoff)
+
+    # reading the tiles. With an index only the tiles of this job are read, instead of the whole geojson
+    if cfg.tiles_index_path is not None:
+        tiles = open_tile_index(cfg.tiles_index_path, cfg.tiles_path)
+    else:
+        tiles = read_geojson(cfg.tiles_path)['features']
     datasets = cfg.datasets
     cfg.update_geojson = True
 
@@ -50,7 +182,6 @@ def main(cfg: DictConfig) -> None:
     # cfg.update_geojson = 'sentinel2' in datasets
     cfg.read_tile_info = not 'sentinel2' in datasets # if we are downloading things other than s2, we need to read the tile information from the geojson. 
 
-    tile_info_dict = {}
     if cfg.read_tile_info:
         logging.info('Reading tile information from geojson. Please note that any errors with the tiles.geojson, implies that you did not download Sentinel 2 yet. Please download Sentinel 2 first. ')
         # tile_info = json.load(open(cfg.tile_info_path, 'r'))
@@ -59,43 +190,61 @@ def main(cfg: DictConfig) -> None:
         tile_info = None
 
 
-    i = cfg.start_from
-    end = min(cfg.end_at, len(gj['features']))
-    
-    start = time.time()
-
-    while i < end:
-        start_ = time.time()
-        logging.info(f'####################### Processing tile [{i}/{len(gj["features"])}] #######################')
-        tile = gj['features'][i]
-        id = tile['properties']['tile_id']
-        if cfg.read_tile_info and id not in tile_info.keys():
-            # this is not in tile info, hence the s2 has not been downloaded yet. so we skip this tile
-            logging.info(f"Tile {id} not in tile_info. Skipping")
-            i += 1
-            continue
-        # creating the ee_set object, the function calls are inside the constructor, hence it will automatically download the data
-        if cfg.read_tile_info:
-            ee_set_ = ee_set(tile, cfg, tile_info=tile_info[id])
-        else:
-            ee_set_ = ee_set(tile, cfg) 
-        logging.debug(f"Time taken for 1 tile: {time.time() - start_}")
-        if cfg.update_geojson and not ee_set_.no_data:
-            tile_info_dict[id] = update_tile_info(tile, ee_set_, tile_info[id] if tile_info is not None else None)
-            os.makedirs(f"{cfg.tile_info_path}", exist_ok=True)
-            with open(f"{cfg.tile_info_path}/tile_info_{cfg.start_from}_{cfg.end_at}.json", 'w') as f:
-                geojson.dump(tile_info_dict, f)
-        elif ee_set_.no_data:
-            logging.info(f"no sentinel2 data for this tile. Skipping")
-            gj['features'].pop(i)
-            i -= 1
+    end = min(cfg.end_at, len(tiles))
+    os.makedirs(f"{cfg.tile_info_path}", exist_ok=True)
+    if cfg.metrics_path is not None:
+        os.makedirs(f"{cfg.metrics_path}", exist_ok=True)
 
+    # the ledger records the state of each tile, so that a restarted job only downloads the tiles that are not complete yet
+    ledger = Ledger(cfg.ledger_path) if cfg.ledger_path is not None else None
 
+    start = time.time()
+    num_tiles = 0
 
-        i += 1
-        # break # we only want to download one tile for now
+    worker = f"{os.environ.get('SLURM_ARRAY_TASK_ID', socket.gethostname())}_{os.getpid()}"
+    if cfg.queue.path is None:
+        # static partitioning, this job downloads the tiles [start_from, end_at)
+        num_tiles += download_range(tiles[cfg.start_from:end], cfg.start_from, cfg.end_at, cfg, tile_info, ledger)
+    else:
+        # work queue, this job leases small batches of tiles from the queue shared by all the jobs until no batch is left
+        queue = WorkQueue(cfg.queue.path, max_attempts=cfg.queue.max_attempts)
+        queue.populate(cfg.start_from, end, cfg.queue.batch_size)
+        while True:
+            batch = queue.lease(worker, cfg.queue.lease_seconds)
+            if batch is None:
+                break
+            batch_id, batch_start, batch_end = batch
+            logging.info(f"Worker {worker} leased batch {batch_id}: tiles [{batch_start}, {batch_end})")
+
+            def renew():
+                if not queue.renew(batch_id, worker, cfg.queue.lease_seconds):
+                    raise LeaseLost(f"Lease of batch {batch_id} expired")
+
+            try:
+                num_tiles += download_range(tiles[batch_start:batch_end], batch_start, batch_end, cfg, tile_info, ledger, on_tile=renew)
+            except LeaseLost as e:
+                # another worker may have leased the batch, and both would write the same tile_info file. The batch is left to that worker
+                logging.warning(f"{e}, worker {worker} stops downloading it")
+                continue
+            if not queue.complete(batch_id, worker):
+                logging.warning(f"Lease of batch {batch_id} was lost, the batch is not marked as done by worker {worker}")
+        logging.info(f"Queue: {queue.counts()}")
+        queue.close()
+
+    if ledger is not None:
+        logging.info(f"Ledger: {ledger.counts()}")
+        ledger.close()
+
+    logging.info(f"Cache: {get_cache().stats()}")
+    for stats in rate_limiter_stats():
+        logging.info(f"Rate limiter: {stats}")
+    # the histograms of the time per stage, also written in the prometheus text format so that the 40 jobs can be compared
+    get_metrics().log_summary()
+    if cfg.metrics_path is not None:
+        write_prometheus(f"{cfg.metrics_path}/metrics_{worker}.prom", labels={'worker': worker})
     logging.info(f"TOTAL TIME TAKEN: {time.time() - start}")
-    logging.info(f"AVG TIME TAKEN: {(time.time() - start)/(end - cfg.start_from)}")
+    logging.info(f"AVG TIME TAKEN: {(time.time() - start)/max(num_tiles, 1)}")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,195 @@
+'''
+Pre-flight check of the tiles before the download. Reads the tiles used by main_download.py (the tiles [start_from, end_at) of tiles_path, or of tiles_index_path)
+and writes a manifest with the expected bands of each dataset, the estimated size of each tile, and the estimated total transfer and storage.
+Tiles with a broken geometry, or with a biome / eco_region that is missing from stats/biome_labels.json / stats/eco_labels.json, are flagged, since
+they would only fail during the download (ee_set) or the conversion (convert_to_h5.py).
+
+This does not send any request to GEE. Usage (same config as main_download.py):
+    python preflight.py start_from=0 end_at=100000
+
+The manifest is written to {tile_info_path}/preflight_{start_from}_{end_at}.jsonl (one line per tile), and the summary to
+{tile_info_path}/preflight_{start_from}_{end_at}_summary.json.
+'''
+
+import json
+import logging
+import math
+import os
+import hydra
+import numpy as np
+from omegaconf import DictConfig
+
+from utils.geometry import exterior_ring, bounds
+from utils.tile_index import open_tile_index
+
+
+BYTES_PER_VALUE = 4 # the datasets are merged into one float32 image
+METERS_PER_DEGREE = 111320
+SCALE = 10 # the export scale in meters
+
+# read on import like in ee_data.py, since hydra may change the working directory before main runs
+with open('./stats/biome_labels.json', 'r') as f:
+    BIOME_LABELS = json.load(f)
+with open('./stats/eco_labels.json', 'r') as f:
+    ECOREGION_LABELS = json.load(f)
+
+
+def expected_bands(cfg):
+    '''
+    Returns the expected bands of each dataset in cfg.datasets, as {name: {'bands': [...], 'channels': n, 'exported': bool}}. channels is the number
+    of channels in the exported image (the largest case when it depends on the tile), and exported is False for datasets that are only stored in
+    the tile_info (era5).
+    '''
+    manifest = {}
+    for name in cfg.datasets:
+        if name == 'sentinel2':
+            bands_l2a, bands_l1c = list(cfg.sentinel2.BANDS[0]), list(cfg.sentinel2.BANDS[1])
+            manifest[name] = {'bands': {'l2a': bands_l2a, 'l1c': bands_l1c}, 'channels': max(len(bands_l2a), len(bands_l1c)), 'exported': True}
+        elif name == 'sentinel1':
+            # an S1 image has one polarisation pair (VV+VH or HH+HV), and we get the ascending and the descending orbit
+            bands = list(cfg.sentinel1.BANDS)
+            manifest[name] = {'bands': {'asc': bands, 'desc': bands}, 'channels': 2 * 2, 'exported': True}
+        elif name == 'aster':
+            bands = list(cfg.aster.BANDS) + ['slope']
+            manifest[name] = {'bands': bands, 'channels': len(bands), 'exported': True}
+        elif name == 'era5':
+            bands = [f"{period}_{band}" for period in ['month1', 'month2', 'year'] for band in cfg.era5.BANDS]
+            manifest[name] = {'bands': bands, 'channels': 0, 'exported': False}
+        elif name == 'canopy_height_eth':
+            manifest[name] = {'bands': ['height', 'std'], 'channels': 2, 'exported': True}
+        elif name in cfg and 'BANDS' in cfg[name]:
+            bands = list(cfg[name].BANDS)
+            manifest[name] = {'bands': bands, 'channels': len(bands), 'exported': True}
+        else:
+            logging.warning(f"Unknown dataset {name}, it is not counted in the estimates")
+    return manifest
+
+
+def geometry_issues(tile):
+    '''
+    Returns a list of the problems with the geometry of a tile, empty if the geometry is fine.
+    '''
+    geometry = tile.get('geometry')
+    if geometry is None or 'coordinates' not in geometry:
+        return ['missing geometry']
+    if geometry.get('type') != 'Polygon':
+        return [f"geometry type {geometry.get('type')} is not Polygon"]
+    try:
+        ring = exterior_ring(geometry['coordinates'])
+    except (ValueError, IndexError, TypeError):
+        return ['invalid coordinates']
+    if ring.ndim != 2 or ring.shape[1] != 2:
+        return ['invalid coordinates']
+
+    issues = []
+    if len(ring) < 4:
+        issues.append('less than 3 vertices')
+    if not np.isfinite(ring).all():
+        issues.append('non finite coordinates')
+    elif (np.abs(ring[:, 0]) > 180).any() or (np.abs(ring[:, 1]) > 90).any():
+        issues.append('coordinates out of range')
+    else:
+        x, y = ring[:, 0], ring[:, 1]
+        if np.sum(x[:-1] * y[1:] - x[1:] * y[:-1]) == 0:
+            issues.append('zero area')
+    return issues
+
+
+def label_issues(tile, biome_labels, eco_labels):
+    properties = tile.get('properties') or {}
+    issues = []
+    if 'tile_id' not in properties:
+        issues.append('missing tile_id')
+    if properties.get('biome') not in biome_labels:
+        issues.append(f"unknown biome: {properties.get('biome')}")
+    if properties.get('eco_region') not in eco_labels:
+        issues.append(f"unknown eco_region: {properties.get('eco_region')}")
+    return issues
+
+
+def tile_pixels(tile):
+    '''
+    Estimates the number of pixels of the tile at the export scale, from its bounds in degrees.
+    '''
+    min_lon, min_lat, max_lon, max_lat = bounds(tile['geometry']['coordinates'])
+    width = (max_lon - min_lon) * METERS_PER_DEGREE * math.cos(math.radians((min_lat + max_lat) / 2))
+    height = (max_lat - min_lat) * METERS_PER_DEGREE
+    return math.ceil(width / SCALE) * math.ceil(height / SCALE)
+
+
+@hydra.main(config_path='config', config_name='config_data')
+def main(cfg: DictConfig) -> None:
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s : %(message)s')
+
+    # with an index only the tiles of the range are read, instead of the whole geojson
+    if cfg.tiles_index_path is not None:
+        tiles = open_tile_index(cfg.tiles_index_path, cfg.tiles_path)
+    else:
+        with open(cfg.tiles_path, 'r') as f:
+            tiles = json.load(f)['features']
+
+    end = min(cfg.end_at, len(tiles))
+    bands = expected_bands(cfg)
+    channels = sum(dataset['channels'] for dataset in bands.values())
+    # in pixels mode the tiles are stored as center crops of image_size x image_size, otherwise the full GeoTIFF is stored
+    crop_bytes = cfg.image_size * cfg.image_size * channels * BYTES_PER_VALUE
+
+    os.makedirs(cfg.tile_info_path, exist_ok=True)
+    manifest_path = f"{cfg.tile_info_path}/preflight_{cfg.start_from}_{cfg.end_at}.jsonl"
+    total_transfer = 0
+    total_storage = 0
+    tile_bytes = []
+    flagged = {} # the number of tiles with each kind of issue
+    num_flagged = 0
+    seen = set()
+    with open(manifest_path, 'w') as f:
+        for position in range(cfg.start_from, end):
+            tile = tiles[position]
+            tile_id = (tile.get('properties') or {}).get('tile_id')
+            bad_geometry = geometry_issues(tile)
+            issues = bad_geometry + label_issues(tile, BIOME_LABELS, ECOREGION_LABELS)
+            if tile_id is not None and tile_id in seen:
+                issues.append('duplicate tile_id')
+            seen.add(tile_id)
+
+            record = {'position': position, 'tile_id': tile_id, 'issues': issues}
+            if len(bad_geometry) == 0:
+                pixels = tile_pixels(tile)
+                transfer = pixels * channels * BYTES_PER_VALUE
+                storage = crop_bytes if cfg.export_mode == 'pixels' else transfer
+                record.update({'pixels': pixels, 'transfer_bytes': transfer, 'storage_bytes': storage})
+                total_transfer += transfer
+                total_storage += storage
+                tile_bytes.append(transfer)
+            for issue in issues:
+                kind = issue.split(':')[0]
+                flagged[kind] = flagged.get(kind, 0) + 1
+            num_flagged += len(issues) > 0
+            f.write(json.dumps(record) + '\n')
+
+    summary = {
+        'tiles_path': cfg.tiles_path,
+        'range': [cfg.start_from, end],
+        'num_tiles': end - cfg.start_from,
+        'datasets': bands,
+        'channels': channels,
+        'bytes_per_tile': {
+            'mean': float(np.mean(tile_bytes)) if tile_bytes else 0,
+            'max': int(np.max(tile_bytes)) if tile_bytes else 0,
+        },
+        'total_transfer_bytes': total_transfer,
+        'total_storage_bytes': total_storage,
+        'num_flagged_tiles': num_flagged,
+        'issues': flagged,
+    }
+    with open(f"{cfg.tile_info_path}/preflight_{cfg.start_from}_{cfg.end_at}_summary.json", 'w') as f:
+        json.dump(summary, f, indent=4)
+
+    logging.info(f"{summary['num_tiles']} tiles, {channels} channels, {summary['bytes_per_tile']['mean'] / 1e6:.2f} MB per tile")
+    logging.info(f"Estimated transfer: {total_transfer / 1e9:.2f} GB, estimated storage: {total_storage / 1e9:.2f} GB")
+    logging.info(f"{summary['num_flagged_tiles']} flagged tiles: {flagged}")
+    logging.info(f"Manifest written to {manifest_path}")
+
+
+if __name__ == '__main__':
+    main()
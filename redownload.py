@@ -1,7 +1,10 @@
+# computes the start and stop indices for the redownload slurm jobs from the tile_info files.
+# NOTE: if the download was run with a ledger (ledger_path in config_data.yaml), this is not needed. Restarting the same jobs skips the tiles that are complete.
 import json
 import os
 import glob
 import argparse
+from utils.utils import read_tile_info
 
 
 # set the following values based on the slurm script. 
@@ -36,7 +39,7 @@ def main(args):
         count = 0
         for f in files:
             print(f)
-            count += len(json.load(open(f, 'r')).keys())
+            count += len(read_tile_info(f))
         print(f"Number of tiles processed: {count}")
         start.append(i-num_tiles_per_job + count)
         stop.append(i)
@@ -65,7 +68,7 @@ if __name__ == '__main__':
     parser.add_argument('--num_of_tiles', type=int, help='total number of tiles already downloaded', default=1300000)
     parser.add_argument('--num_of_jobs', type=int, help='total number of parallel slurm jobs when downloading the full tiles', default=40)
     parser.add_argument('--num_tiles_per_job', type=int, help='total number of tiles processed per job', default=33000)
-    parser.add_argument('--tile_info_path', type=str, help='path to the tile_info files', default='data/tile_info/*.json', required=True)
+    parser.add_argument('--tile_info_path', type=str, help='path to the tile_info files', default='data/tile_info/tile_info_*', required=True)
 
     args = parser.parse_args()
 
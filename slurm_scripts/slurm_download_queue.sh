@@ -0,0 +1,23 @@
+#!/bin/bash
+#SBATCH --job-name=download-queue
+
+#SBATCH --array=0-39
+#SBATCH --tasks=1
+#SBATCH --cpus-per-task=4
+#SBATCH --time=20-00:00:00
+# PATH TO SAVE SLURM LOGS
+#SBATCH --output=/home/qbk152/vishal/slurm_logs/slurm-%A_%a_%x.out
+# TOTAL MEMORY PER NODE
+#SBATCH --mem=16G 
+#SBATCH --exclude=hendrixgpu01fl,hendrixgpu02fl,hendrixgpu07fl,hendrixgpu08fl,hendrixgpu03fl,hendrixgpu04fl
+
+echo "SLURM_JOB_NODELIST: $SLURM_JOB_NODELIST"
+
+# all the jobs share the same queue and the same range of tiles. Each job leases small batches of tiles until all the batches are done,
+# hence there is no need to split the tiles between the jobs, or to compute new ranges with redownload.py
+queue_path=/projects/dereeco/data/global-lr/data_1M_v001/queue.db
+ledger_path=/projects/dereeco/data/global-lr/data_1M_v001/ledger.db
+start_from=0
+end_at=1500000
+
+python /home/qbk152/vishal/MMEarth-data/main_download.py start_from=$start_from end_at=$end_at queue.path=$queue_path ledger_path=$ledger_path
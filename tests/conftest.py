@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the modules of the repo (utils, ee_utils) like the scripts at the root of the repo do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
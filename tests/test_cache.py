@@ -0,0 +1,37 @@
+'''
+Tests of the LRU and the SQLite file of utils/cache.py.
+'''
+
+from utils.cache import ResultCache
+
+
+def test_least_recently_used_values_are_dropped():
+    cache = ResultCache(max_size=2)
+    cache.put(('bands', 'a'), ['b1'])
+    cache.put(('bands', 'b'), ['b2'])
+    assert cache.get(('bands', 'a')) == ['b1']
+    cache.put(('bands', 'c'), ['b3'])
+    assert cache.get(('bands', 'b')) is None
+    assert cache.get(('bands', 'a')) == ['b1']
+    assert cache.get(('bands', 'c')) == ['b3']
+
+
+def test_values_are_shared_through_the_file(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    ResultCache(path=path).put(('era5', '2019-06', [1, 2]), {'t2m': 290.5})
+    other = ResultCache(path=path)
+    assert other.get_or_compute(('era5', '2019-06', [1, 2]), lambda: None) == {'t2m': 290.5}
+    assert other.stats()['hits'] == 1
+
+
+def test_none_is_not_cached():
+    cache = ResultCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return None
+
+    assert cache.get_or_compute('key', compute) is None
+    assert cache.get_or_compute('key', compute) is None
+    assert len(calls) == 2
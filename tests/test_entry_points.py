@@ -0,0 +1,34 @@
+'''
+Smoke tests of the scripts that are run directly (python utils/<script>.py), as documented in the README and the slurm scripts.
+'''
+
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_help(script):
+    return subprocess.run([sys.executable, script, '--help'], cwd=ROOT, capture_output=True, text=True)
+
+
+def test_convert_to_h5_runs_as_script():
+    pytest.importorskip('h5py')
+    pytest.importorskip('tifffile')
+    result = run_help('utils/convert_to_h5.py')
+    assert result.returncode == 0, result.stderr
+
+
+def test_chunking_h5_runs_as_script():
+    pytest.importorskip('h5py')
+    result = run_help('utils/chunking_h5.py')
+    assert result.returncode == 0, result.stderr
+
+
+def test_utils_imports_without_the_gee_backend():
+    pytest.importorskip('geojson')
+    code = "import sys; sys.modules['ee'] = None; import utils.utils; assert 'ee_utils.backend' not in sys.modules"
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,24 @@
+'''
+Tests of the local geometry of the tiles in utils/geometry.py.
+'''
+
+import pytest
+from utils.geometry import bounds, centroid, grid_cell
+
+# a 0.01 degree square, open ring like some of the GeoJSON files
+SQUARE = [[[10.0, 50.0], [10.01, 50.0], [10.01, 50.01], [10.0, 50.01]]]
+
+
+def test_centroid_of_a_square():
+    assert centroid(SQUARE) == pytest.approx((10.005, 50.005))
+
+
+def test_bounds():
+    assert bounds(SQUARE) == pytest.approx((10.0, 50.0, 10.01, 50.01))
+
+
+def test_grid_cell():
+    # 0.25 degree cells from the top left corner (-180, 90)
+    assert grid_cell((10.1, 50.1, 10.11, 50.11), 0.25, (-180, 90)) == (760, 159)
+    # a tile across the border of two cells
+    assert grid_cell((10.24, 50.0, 10.26, 50.01), 0.25, (-180, 90)) is None
@@ -0,0 +1,45 @@
+'''
+Tests of the per modality states of utils/ledger.py.
+'''
+
+import pytest
+from utils.ledger import Ledger, PENDING, DOWNLOADED, FAILED, NO_DATA
+
+
+def test_completed_with_mixed_states(tmp_path):
+    ledger = Ledger(str(tmp_path / 'ledger.db'))
+    modalities = ['sentinel2', 'sentinel1', 'aster']
+    ledger.mark('t1', modalities, DOWNLOADED)
+    ledger.mark_states('t2', {'sentinel2': DOWNLOADED, 'sentinel1': NO_DATA, 'aster': DOWNLOADED})
+    ledger.mark_states('t3', {'sentinel2': DOWNLOADED, 'sentinel1': FAILED, 'aster': DOWNLOADED})
+    ledger.mark_states('t4', {'sentinel2': DOWNLOADED, 'sentinel1': DOWNLOADED, 'aster': PENDING})
+    # t5 only has two of the three modalities
+    ledger.mark('t5', ['sentinel2', 'sentinel1'], DOWNLOADED)
+    ledger.mark('t6', modalities, NO_DATA)
+
+    assert ledger.completed(modalities) == {'t1', 't2', 't6'}
+    assert ledger.completed(modalities, ['t1', 't3', 't5', 'missing']) == {'t1'}
+    # the modalities that are not asked for do not matter
+    assert ledger.completed(['sentinel2', 'sentinel1']) == {'t1', 't2', 't4', 't5', 't6'}
+    assert ledger.states('t3') == {'sentinel2': DOWNLOADED, 'sentinel1': FAILED, 'aster': DOWNLOADED}
+
+
+def test_completed_with_many_tiles(tmp_path):
+    ledger = Ledger(str(tmp_path / 'ledger.db'))
+    for i in range(1200):
+        ledger.mark(f"t{i}", ['sentinel2'], DOWNLOADED if i % 2 == 0 else FAILED)
+    # more tiles than the chunk of one query
+    assert ledger.completed(['sentinel2'], [f"t{i}" for i in range(1200)]) == {f"t{i}" for i in range(0, 1200, 2)}
+
+
+def test_mark_overwrites_the_state(tmp_path):
+    ledger = Ledger(str(tmp_path / 'ledger.db'))
+    ledger.mark('t1', ['sentinel2'], PENDING)
+    ledger.mark('t1', ['sentinel2'], DOWNLOADED)
+    assert ledger.counts() == {DOWNLOADED: 1}
+
+
+def test_invalid_state(tmp_path):
+    ledger = Ledger(str(tmp_path / 'ledger.db'))
+    with pytest.raises(ValueError):
+        ledger.mark('t1', ['sentinel2'], 'done')
@@ -0,0 +1,50 @@
+'''
+Tests of utils/parallel.py.
+'''
+
+import random
+import threading
+import time
+import pytest
+from utils.parallel import imap_ordered
+
+
+def test_results_are_in_the_order_of_the_items():
+    def work(i):
+        time.sleep(random.uniform(0, 0.01))
+        return i * i
+
+    items = list(range(50))
+    assert list(imap_ordered(work, items, num_workers=8)) == [(i, i * i) for i in items]
+    assert list(imap_ordered(work, items, num_workers=1)) == [(i, i * i) for i in items]
+
+
+def test_items_in_flight_are_bounded():
+    lock = threading.Lock()
+    started = []
+
+    def work(i):
+        with lock:
+            started.append(i)
+        return i
+
+    def items():
+        for i in range(100):
+            yield i
+
+    for i, _ in imap_ordered(work, items(), num_workers=4, max_in_flight=6):
+        time.sleep(0.001)
+        # the item i is yielded once it is done, and at most max_in_flight items were submitted at that time
+        with lock:
+            assert len(started) <= i + 6
+    assert sorted(started) == list(range(100))
+
+
+def test_errors_are_raised():
+    def work(i):
+        if i == 3:
+            raise ValueError('bad tile')
+        return i
+
+    with pytest.raises(ValueError):
+        list(imap_ordered(work, range(10), num_workers=4))
@@ -0,0 +1,64 @@
+'''
+Tests of the rate limit errors of utils/rate_limiter.py.
+'''
+
+from types import SimpleNamespace
+import pytest
+from utils.rate_limiter import AdaptiveRateLimiter, is_rate_limit_error
+
+
+class ResponseError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status code {status_code}")
+        self.response = SimpleNamespace(status_code=status_code)
+
+
+@pytest.mark.parametrize('error', [
+    Exception('Too many concurrent aggregations.'),
+    Exception('Quota exceeded for this project'),
+    Exception('429 Client Error: Too Many Requests for url: https://earthengine.googleapis.com'),
+    Exception('HTTP 429'),
+    Exception('Error: 429'),
+    Exception('request failed with status 429'),
+    ResponseError(429),
+])
+def test_rate_limit_errors(error):
+    assert is_rate_limit_error(error)
+
+
+@pytest.mark.parametrize('error', [
+    Exception('Image.load: Image asset COPERNICUS/S2/20190429T103031 not found.'),
+    Exception('Incomplete download: expected 4290 bytes, got 1429'),
+    Exception('Internal error.'),
+    ResponseError(500),
+])
+def test_other_errors(error):
+    assert not is_rate_limit_error(error)
+
+
+def test_throttle_decreases_the_rate():
+    limiter = AdaptiveRateLimiter('test', rate=10.0, min_rate=1.0, max_retries=1, backoff=0.0)
+    calls = []
+
+    def throttled_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise Exception('Too many concurrent aggregations.')
+        return 'ok'
+
+    assert limiter.call(throttled_once) == 'ok'
+    assert limiter.rate < 10.0
+    assert limiter.throttles == 1
+
+
+def test_other_errors_are_not_retried():
+    limiter = AdaptiveRateLimiter('test', rate=10.0, max_retries=3, backoff=0.0)
+    calls = []
+
+    def fails():
+        calls.append(1)
+        raise ValueError('Internal error.')
+
+    with pytest.raises(ValueError):
+        limiter.call(fails)
+    assert len(calls) == 1
@@ -0,0 +1,49 @@
+'''
+Tests of the leases of utils/work_queue.py.
+'''
+
+from utils.work_queue import WorkQueue, PENDING, LEASED, DONE, FAILED
+
+
+def make_queue(tmp_path, max_attempts = None):
+    queue = WorkQueue(str(tmp_path / 'queue.db'), max_attempts=max_attempts)
+    queue.populate(0, 10, 4)
+    return queue
+
+
+def test_populate_splits_the_range_in_batches(tmp_path):
+    queue = make_queue(tmp_path)
+    # populating again (another worker starting) keeps the existing batches
+    queue.populate(0, 10, 4)
+    assert queue.counts() == {PENDING: 3}
+    assert [queue.lease('a', 60)[1:] for _ in range(3)] == [(0, 4), (4, 8), (8, 10)]
+    assert queue.lease('a', 60) is None
+
+
+def test_expired_lease_is_given_to_another_worker(tmp_path):
+    queue = make_queue(tmp_path)
+    batch_id, _, _ = queue.lease('a', -1)
+    assert queue.lease('b', 60)[0] == batch_id
+    # worker a lost the lease, it can neither renew nor complete the batch
+    assert not queue.renew(batch_id, 'a', 60)
+    assert not queue.complete(batch_id, 'a')
+    assert queue.renew(batch_id, 'b', 60)
+    assert queue.complete(batch_id, 'b')
+    assert queue.counts() == {DONE: 1, PENDING: 2}
+
+
+def test_lease_that_did_not_expire_is_kept(tmp_path):
+    queue = make_queue(tmp_path)
+    batch_id, _, _ = queue.lease('a', 60)
+    assert queue.lease('b', 60)[0] != batch_id
+    assert queue.counts() == {LEASED: 2, PENDING: 1}
+
+
+def test_batch_fails_after_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2)
+    batch_id, _, _ = queue.lease('a', -1)
+    assert queue.lease('b', -1)[0] == batch_id
+    # the batch was leased twice and expired again, it is not given to a third worker
+    assert queue.lease('c', 60)[0] != batch_id
+    assert queue.counts()[FAILED] == 1
+    assert not queue.complete(batch_id, 'b')
@@ -0,0 +1,49 @@
+'''
+A simple array store used when the data is downloaded with export_mode: pixels. Each tile is stored as an (H, W, C) .npy file, and the files are
+spread over a fixed number of sub folders (shards), so that no single folder holds a million files.
+
+    {root}/{data_name}/{shard}/{tile_id}.npy
+'''
+
+import os
+import tempfile
+import zlib
+import numpy as np
+from utils.files import replace_file
+
+
+NUM_SHARDS = 256
+
+
+def shard_path(root, data_name, tile_id, num_shards = NUM_SHARDS):
+    '''
+    Returns the path of the array of a tile. The shard is computed from the tile_id, so the path of a tile is always the same.
+    '''
+    shard = zlib.crc32(str(tile_id).encode('utf-8')) % num_shards
+    return os.path.join(root, data_name, f"{shard:03d}", f"{tile_id}.npy")
+
+
+def write_array(path, arr):
+    '''
+    Writes the array to a temporary file, and renames it to path once it is complete. Hence readers never see a partially written array.
+    '''
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.' + os.path.basename(path) + '.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, arr)
+        replace_file(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_array(path):
+    '''
+    Reads an array written by write_array. Returns None if the array does not exist.
+    '''
+    if not os.path.exists(path):
+        return None
+    return np.load(path)
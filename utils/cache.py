@@ -0,0 +1,108 @@
+'''
+A cache for values resolved from GEE that are shared by many tiles, e.g. the band names of a collection, or the ERA5 values of a month for tiles in the
+same ERA5 pixel. The values are kept in an in-memory LRU, and optionally in a SQLite file so that they are shared between processes and runs.
+
+The keys are tuples (collection, date window, spatial cell, ...) and the values must be json serializable.
+'''
+
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+# the process wide cache, created by configure_cache
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class ResultCache:
+    def __init__(self, max_size = 100000, path = None, timeout = 60):
+        '''
+        max_size is the number of values kept in memory. If path is given, the values are also stored in a SQLite file at path.
+        '''
+        self.max_size = max_size
+        self.path = path
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+        if path is not None:
+            self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+            with self.lock, self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def get(self, key):
+        '''
+        Returns the cached value for key, or None if it is not cached.
+        '''
+        key = json.dumps(key)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            if self.conn is not None:
+                row = self.conn.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        key = json.dumps(key)
+        with self.lock:
+            self._remember(key, value)
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def get_or_compute(self, key, compute):
+        '''
+        Returns the cached value for key, or calls compute() and caches its result. Two threads asking for the same missing key at the same time
+        may both call compute, this is fine since the results are the same.
+        '''
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.memory)}
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+
+def configure_cache(max_size = 100000, path = None):
+    '''
+    Creates the process wide cache used by ee_set.
+    '''
+    global _cache
+    cache = ResultCache(max_size=max_size, path=path)
+    with _cache_lock:
+        _cache = cache
+    logging.debug(f"Result cache with {max_size} values in memory, stored at {path}")
+    return cache
+
+
+def get_cache():
+    '''
+    Returns the process wide cache. An in-memory cache is created with the default settings if configure_cache was not called.
+    '''
+    with _cache_lock:
+        cache = _cache
+    if cache is None:
+        cache = configure_cache()
+    return cache
@@ -1,9 +1,180 @@
-# take an existing h5 file, and create a new one with the same data but by using chunks.
+# take an existing h5 file, and create a new one with the same data but with other chunks and codecs.
 
+'''
+Rechunks an h5 file. Each dataset is copied in large blocks of rows, aligned to the chunks of the source and of the target dataset so that every chunk
+is read and written whole, and the datasets are copied at the same time by num_workers processes. The layout and the codec of the new datasets come
+from utils/h5_layout.py, and can be set per dataset with a json file, e.g.
+    {"sentinel2": {"layout": "sample", "codec": "zstd", "level": 5}, "eco_region": {"layout": "scan", "codec": "lz4"}, "aster": {"chunks": [8, 2, 128, 128]}}
+
+All the datasets are created in {output_path}.tmp first, and the workers write their blocks into this file. HDF5 cannot be written by several processes
+at once, hence the workers read and decompress their blocks in parallel, but take turns (a lock on {output_path}.lock) to write them. After every block,
+the number of rows copied is written to a checkpoint in {output_path}.checkpoints/. If the job is killed, running it again with the same arguments
+resumes every dataset from its checkpoint. Once all the datasets are copied, {output_path}.tmp is renamed to output_path. The disk space needed is the
+size of the source plus the size of the output, and every block is written once.
+
+Usage (from the root of the repo, python -m utils.chunking_h5 works the same):
+    python utils/chunking_h5.py --h5_file_path data_1M_v001.h5 --layout scan --codec zstd --num_workers 8
+'''
+
+import argparse
+import fcntl
+import json
+import math
+import os
+import shutil
+import sys
+from multiprocessing import Pool
 import h5py
 import numpy as np
-import os
-import argparse
+# the repo root goes first, otherwise 'utils' is utils/utils.py (the folder of this script) instead of the utils package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.h5_layout import LAYOUTS, CODECS, dataset_options
+
+try:
+    # registers the lz4, zstd and blosc filters, needed to read and write the datasets that use them
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+def target_options(dataset, spec):
+    '''
+    Returns the create_dataset arguments of the new dataset. spec has the layout, codec, level and shuffle, and optionally chunks (the full chunk
+    shape) or chunk_rows (the number of samples per chunk).
+    '''
+    options = dataset_options(dataset.shape[1:], dataset.dtype, spec['layout'], spec['codec'], spec.get('level'), spec.get('shuffle', True),
+                              num_samples=dataset.shape[0])
+    if spec.get('chunks') is not None:
+        options['chunks'] = tuple(spec['chunks'])
+    elif spec.get('chunk_rows') is not None:
+        options['chunks'] = (min(spec['chunk_rows'], max(dataset.shape[0], 1)), *options['chunks'][1:])
+    return options
+
+
+def block_rows(dataset, chunks, block_bytes):
+    '''
+    Returns the number of rows copied at once: a multiple of the rows of a chunk of the source and of the target, of about block_bytes.
+    '''
+    source_rows = dataset.chunks[0] if dataset.chunks is not None else 1
+    rows = source_rows * chunks[0] // math.gcd(source_rows, chunks[0])
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+    return rows * max(1, block_bytes // max(rows * row_bytes, 1))
+
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return {'rows_done': 0, 'done': False}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_checkpoint(path, state):
+    # written to a temporary file and renamed, so a killed job never leaves a broken checkpoint
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def create_datasets(h5_file_path, tmp_path, keys, specs):
+    '''
+    Creates the output file with all the datasets (empty, with their chunks and codec) and the attributes of the source. The datasets without rows
+    are copied as they are. The file is renamed to tmp_path once all the datasets are created, so a resumed job never finds a dataset missing.
+    '''
+    with h5py.File(h5_file_path, 'r') as h5, h5py.File(tmp_path + '.new', 'w') as out:
+        for name, value in h5.attrs.items():
+            out.attrs[name] = value
+        for key in keys:
+            dataset = h5[key]
+            if dataset.ndim == 0:
+                out.create_dataset(key, data=dataset[()])
+            else:
+                out.create_dataset(key, shape=dataset.shape, dtype=dataset.dtype, **target_options(dataset, specs[key]))
+            for name, value in dataset.attrs.items():
+                out[key].attrs[name] = value
+    os.replace(tmp_path + '.new', tmp_path)
+
+
+def rechunk_dataset(job):
+    '''
+    Copies one dataset of the source file to the output file, from its checkpoint onwards. Runs in the worker processes.
+    '''
+    h5_file_path, key, tmp_path, lock_path, checkpoint_path, block_bytes = job
+    state = read_checkpoint(checkpoint_path)
+    if state['done']:
+        print(f'{key}: already copied')
+        return key
+
+    with h5py.File(h5_file_path, 'r') as h5:
+        dataset = h5[key]
+        num_rows = dataset.shape[0] if dataset.ndim > 0 else 0
+        with open(lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with h5py.File(tmp_path, 'r') as out:
+                    chunks = out[key].chunks
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        step = block_rows(dataset, chunks, block_bytes) if num_rows > 0 else 1
+
+        start = state['rows_done']
+        while start < num_rows:
+            end = min(start + step, num_rows)
+            block = dataset[start:end]
+            # the output file is only opened by one worker at a time, and closed (hence flushed) before the checkpoint, so the checkpoint never
+            # counts rows that are not on disk
+            with open(lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with h5py.File(tmp_path, 'a') as out:
+                        out[key][start:end] = block
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            state['rows_done'] = end
+            write_checkpoint(checkpoint_path, state)
+            print(f'{key}: {end}/{num_rows}')
+            start = end
+
+    state['done'] = True
+    write_checkpoint(checkpoint_path, state)
+    return key
+
+
+def rechunk(h5_file_path, output_path, spec, key_specs = None, num_workers = 1, block_bytes = 256 << 20, keep_checkpoints = False):
+    '''
+    Rechunks h5_file_path into output_path. spec is the layout and codec of all the datasets, and key_specs the overrides of some datasets.
+    '''
+    key_specs = key_specs or {}
+    tmp_path = output_path + '.tmp'
+    lock_path = output_path + '.lock'
+    checkpoints_dir = output_path + '.checkpoints'
+
+    with h5py.File(h5_file_path, 'r') as h5:
+        keys = [key for key in h5.keys() if isinstance(h5[key], h5py.Dataset)]
+
+    if not os.path.exists(tmp_path):
+        # the checkpoints of a previous run are only valid with its output file
+        shutil.rmtree(checkpoints_dir, ignore_errors=True)
+        create_datasets(h5_file_path, tmp_path, keys, {key: {**spec, **key_specs.get(key, {})} for key in keys})
+    os.makedirs(checkpoints_dir, exist_ok=True)
+
+    jobs = []
+    for key in keys:
+        jobs.append((h5_file_path, key, tmp_path, lock_path, os.path.join(checkpoints_dir, key + '.json'), block_bytes))
+
+    if num_workers <= 1:
+        for job in jobs:
+            rechunk_dataset(job)
+    else:
+        with Pool(num_workers) as pool:
+            for key in pool.imap_unordered(rechunk_dataset, jobs):
+                print(f'{key}: done')
+
+    os.replace(tmp_path, output_path)
+    if os.path.exists(lock_path):
+        os.remove(lock_path)
+    if not keep_checkpoints:
+        shutil.rmtree(checkpoints_dir)
+    print('Done! ', output_path)
 
 
 def create_h5_file_with_chunks(h5_file_path = '', chunk_size = 1):
@@ -13,47 +184,34 @@ def create_h5_file_with_chunks(h5_file_path = '', chunk_size = 1):
     :param chunk_size: chunk size to use.
     :return: None
     """
-    # open the original file
-    h5 = h5py.File(h5_file_path, 'r')
-    keys = list(h5.keys())
-    # create a new file
     name = h5_file_path.split('/')[-1][:-3]
     new_h5_file_path = os.path.join(os.path.dirname(h5_file_path), name + '_chunked_gzip.h5')
-    print(new_h5_file_path)
-    if os.path.exists(new_h5_file_path):
-        os.remove(new_h5_file_path)
-        
-    new_h5 = h5py.File(new_h5_file_path, 'w')
-    # the dataset is too big to load into memory, so we will iterate over the keys
-    meta = h5['metadata']
-    num_samples = meta.shape[0]
-    for key in keys:
-        print('creating dataset for key: ', key)
-        shape = h5[key].shape
-        tmp = new_h5.create_dataset(key, shape = h5[key].shape, dtype = h5[key].dtype, chunks = (chunk_size, *shape[1:]), compression = 'gzip')
-
-        # iterate over the samples
-        for i in range(num_samples):
-            if i % 1000 == 0:
-                print(key, i)
-            # get the sample
-            sample = h5[key][i]
-            # write the sample to the new file
-            tmp[i] = sample
-
-        
-
-
-    # close the files
-    h5.close()
-    new_h5.close()
+    rechunk(h5_file_path, new_h5_file_path, {'layout': 'sample', 'codec': 'gzip', 'shuffle': False, 'chunk_rows': chunk_size})
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--h5_file_path', type=str, help='path to the h5 file', required=True)
-    parser.add_argument('--chunk_size', type=int, help='chunk size to use', default=1)
+    parser.add_argument('--output_path', type=str, default='', help='path to the new h5 file, {name}_rechunked.h5 next to the original file by default')
+    parser.add_argument('--layout', type=str, default='sample', choices=LAYOUTS, help='chunk layout of the new datasets, see utils/h5_layout.py')
+    parser.add_argument('--codec', type=str, default='gzip', choices=CODECS, help='compression codec of the new datasets')
+    parser.add_argument('--compression_level', type=int, default=None, help='compression level, default of the codec if not set')
+    parser.add_argument('--no_shuffle', dest='shuffle', action='store_false', help='disable the byte shuffle filter before the codec')
+    parser.add_argument('--chunk_size', type=int, default=None, help='number of samples per chunk, from the layout if not set')
+    parser.add_argument('--key_options', type=str, default='', help='json file with the layout, codec, level, shuffle, chunks or chunk_rows of some datasets')
+    parser.add_argument('--num_workers', type=int, default=1, help='number of datasets copied at the same time')
+    parser.add_argument('--block_mb', type=int, default=256, help='size in MB of the blocks of rows copied at once by each worker')
+    parser.add_argument('--keep_checkpoints', action='store_true', help='keep the checkpoints once the new file is complete')
     args = parser.parse_args()
 
-    create_h5_file_with_chunks(h5_file_path = args.h5_file_path, chunk_size = args.chunk_size)
\ No newline at end of file
+    if args.output_path == '':
+        name = args.h5_file_path.split('/')[-1][:-3]
+        args.output_path = os.path.join(os.path.dirname(args.h5_file_path), name + '_rechunked.h5')
+    key_specs = {}
+    if args.key_options != '':
+        with open(args.key_options, 'r') as f:
+            key_specs = json.load(f)
+
+    spec = {'layout': args.layout, 'codec': args.codec, 'level': args.compression_level, 'shuffle': args.shuffle, 'chunk_rows': args.chunk_size}
+    rechunk(args.h5_file_path, args.output_path, spec, key_specs, args.num_workers, args.block_mb << 20, args.keep_checkpoints)
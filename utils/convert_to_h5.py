@@ -5,74 +5,51 @@ A python script to do the pre-processing and convert the data to h5 format. It w
 
 import argparse
 import os
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
 import h5py
 import numpy as np
 import json
 import tifffile as tiff
+import sys
+# the repo root goes first, otherwise 'utils' is utils/utils.py (the folder of this script) instead of the utils package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.array_store import shard_path, read_array
+from utils.modalities import MODALITIES, is_image, h5_shape, image_offsets, extract_image_modality
+from utils.h5_layout import LAYOUTS, CODECS, dataset_options
 
 
 
 
-MODALITIES = {
-            'sentinel2': {'dtype': 'uint16', 'n_bands': 13, 'bands': ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8A', 'B8', 'B9', 'B10', 'B11', 'B12']},
-            'sentinel2_cloudmask': {'dtype': 'uint16', 'n_bands': 1, 'bands': ['QA60']},
-            'sentinel2_cloudprod': {'dtype': 'uint16', 'n_bands': 1, 'bands': ['MSK_CLDPRB']},
-            'sentinel2_scl': {'dtype': 'uint8', 'n_bands': 1, 'bands': ['SCL']},
-            'sentinel1': {'dtype': 'float32', 'n_bands': 8, 'bands': ['asc_VV', 'asc_VH', 'asc_HH', 'asc_HV', 'desc_VV', 'desc_VH', 'desc_HH', 'desc_HV']},
-            'aster': {'dtype': 'int16', 'n_bands': 2, 'bands': ['elevation', 'slope']},
-            'era5': {'dtype': 'float32', 'n_bands': 12, 'bands': ['prev_month_avg_temp', 'prev_month_min_temp', 'prev_month_max_temp', 'prev_month_total_precip', 'curr_month_avg_temp', 'curr_month_min_temp', 'curr_month_max_temp', 'curr_month_total_precip', 'year_avg_temp', 'year_min_temp', 'year_max_temp', 'year_total_precip']},
-            'dynamic_world': {'dtype': 'uint8', 'n_bands': 1, 'bands': ['landcover']},
-            'canopy_height_eth': {'dtype': 'int8', 'n_bands': 2, 'bands': ['height', 'std']},
-            'lat': {'dtype': 'float32', 'n_bands': 2, 'bands': ['sin', 'cos']},
-            'lon': {'dtype': 'float32', 'n_bands': 2, 'bands': ['sin', 'cos']},
-            'biome': {'dtype': 'uint8', 'n_bands': 1},
-            'eco_region': {'dtype': 'uint16', 'n_bands': 1},
-            'month': {'dtype': 'float32', 'n_bands': 2, 'bands': ['sin', 'cos']},
-            'esa_worldcover':{ 'dtype': 'uint8', 'n_bands': 1, 'bands': ['map']}
-}
-
-sentinel2_bands = [
-    'B1',
-    'B2',
-    'B3',
-    'B4',
-    'B5',
-    'B6',
-    'B7',
-    'B8A',
-    'B8',
-    'B9',
-    'B10',
-    'B11',
-    'B12',
-]
-
-# MODALITIES_IN_IMAGE = [
-#     'sentinel2',
-#     'sentinel1_asc',
-#     'sentinel1_desc',
-#     'aster',
-#     'dynamic_world',
-#     'canopy_height_eth',
-#     'esa_worldcover'
-
-# ]
-
 variables = {}
 remove = []
 
 
+def load_tile(data_dir, tile_id):
+    '''
+    Loads the merged image of a tile as an (H, W, C) array. The tile is read from merged/{tile_id}.tif, or from the array store
+    (merged/{shard}/{tile_id}.npy) if the data was downloaded with export_mode: pixels. Returns None if the tile was not downloaded.
+    '''
+    tif_path = os.path.join(data_dir, 'merged', tile_id + '.tif')
+    if os.path.exists(tif_path):
+        try:
+            return tiff.imread(tif_path)
+        except:
+            return None
+    return read_array(shard_path(data_dir, 'merged', tile_id))
+
 
-def read_data(tile_id, tile_info, data_dir, img_size, exisiting_datasets=None):
+
+def read_data(data, tile_info, img_size, exisiting_datasets=None):
+    '''
+    Reads the modalities of a tile from its merged image (as returned by load_tile). The image modalities are extracted from the merged image with the
+    band mapping tables of utils/modalities.py, and the other modalities are computed from the tile information. Missing bands are filled with the no
+    data value of the modality.
+    '''
     tile_info_bands = tile_info['BANDS']
-    type = tile_info['S2_type']
-    try:
-        data = tiff.imread(os.path.join(data_dir, tile_id + '.tif'))
-    except:
-        return None
     return_data_dict = {}
-    count = 0 # this represents the count of the bands, we use this since all the bands are stacked in the same order
-    
+
     # creating a center crop of size img_size
     start_x = (data.shape[0] - img_size) // 2
     start_y = (data.shape[1] - img_size) // 2
@@ -83,130 +60,113 @@ def read_data(tile_id, tile_info, data_dir, img_size, exisiting_datasets=None):
         if exisiting_datasets is not None and modality not in exisiting_datasets:
             continue
 
-        
-        ### SENTINEL 2 ###
-        if modality == 'sentinel2':
-            placeholder = np.zeros((13, img_size, img_size), dtype='uint16')
-            count += len(tile_info_bands['sentinel2']) - 3 if type == 'l2a' else len(tile_info_bands['sentinel2']) - 1
-            for i, band in enumerate(sentinel2_bands):
-                if band in tile_info_bands['sentinel2']:
-                    placeholder[i] = np.expand_dims(data[:, :, tile_info_bands['sentinel2'].index(band)], 2).transpose(2, 0, 1)
-            return_data_dict['sentinel2'] = placeholder
-
-        if modality == 'sentinel2_cloudmask':
-            if 'QA60' in tile_info_bands['sentinel2']:
-                return_data_dict['sentinel2_cloudmask'] = np.expand_dims(data[:, :, tile_info_bands['sentinel2'].index('QA60')], 2).transpose(2, 0, 1)
-                count += 1
-            else:
-                return_data_dict['sentinel2_cloudmask'] = np.ones((1, img_size, img_size), dtype='uint16') * 65535
-
-        if modality == 'sentinel2_cloudprod':
-            
-            if 'MSK_CLDPRB' in tile_info_bands['sentinel2']:
-                count += 1
-                return_data_dict['sentinel2_cloudprod'] = np.expand_dims(data[:, :, tile_info_bands['sentinel2'].index('MSK_CLDPRB')], 2).transpose(2, 0, 1)
-            else:
-                return_data_dict['sentinel2_cloudprod'] = np.ones((1, img_size, img_size), dtype='uint16') * 65535
-
-
-        if modality == 'sentinel2_scl':
-            if 'SCL' in tile_info_bands['sentinel2']:
-                count += 1
-                return_data_dict['sentinel2_scl'] = np.expand_dims(data[:, :, tile_info_bands['sentinel2'].index('SCL')], 2).transpose(2, 0, 1)
-            else:
-                return_data_dict['sentinel2_scl'] = np.ones((1, img_size, img_size), dtype='uint8') * 255
-
-
-
-        ### SENTINEL 1 ###
-        if modality == 'sentinel1':
-            bands_map = {'VV': 0, 'VH': 1, 'HH': 2, 'HV': 3}
-            orbit_map = {'asc': 0, 'desc': 4}
-            tmp = np.ones((8, img_size, img_size), dtype='float32') * float('-inf')
-            for orbit in ['asc', 'desc']:
-                if tile_info_bands[f'sentinel1_{orbit}'] is not None:
-                    bands_img = tile_info_bands[f'sentinel1_{orbit}']
-                    count += len(bands_img)
-                    for i, band in enumerate(bands_img):
-                        tmp[orbit_map[orbit] + bands_map[band]] = data[:, :, count - len(bands_img) + i]
-
-            return_data_dict['sentinel1'] = tmp
-
-        ### ASTER ###
-        if modality == 'aster':
-            count += len(tile_info_bands['aster'])
-            return_data_dict['aster'] = data[:, :, count - len(tile_info_bands['aster']):count].transpose(2, 0, 1)
+        if is_image(modality):
+            return_data_dict[modality] = extract_image_modality(modality, data, tile_info_bands)
 
         ### ERA5 ###
-        if modality == 'era5':
-
-            era_data = tile_info['era5']
-            
-            return_data_dict['era5'] = np.stack([era_data['month1'] + era_data['month2'] + era_data['year']], axis=0).astype('float32')
-
-        ### DYNAMIC WORLD ###
-        if modality == 'dynamic_world':
-            try:
-                count += len(tile_info_bands['dynamic_world'])
-                return_data_dict['dynamic_world'] = np.expand_dims(data[:, :, count - len(tile_info_bands['dynamic_world'])], axis = 0)
-            except Exception as e:
-                print('dynamic_world not found')
-                return_data_dict['dynamic_world'] = np.zeros((1, img_size, img_size), dtype='uint8')
-            
-
-        ### CANOPY HEIGHT ###
-        if modality == 'canopy_height_eth':
-            count += len(tile_info_bands['canopy_height_eth']) 
-            tmp = data[:, :, count - len(tile_info_bands['canopy_height_eth']):count].transpose(2, 0, 1)
-            if tmp.shape[0] == 0:
-                return_data_dict['canopy_height_eth'] = np.ones((2, img_size, img_size), dtype='int8') * 255
+        elif modality == 'era5':
+            if 'era5' in tile_info:
+                era_data = tile_info['era5']
+                return_data_dict['era5'] = np.array(era_data['month1'] + era_data['month2'] + era_data['year'], dtype='float32')
             else:
-                return_data_dict['canopy_height_eth'] = data[:, :, count - len(tile_info_bands['canopy_height_eth']):count].transpose(2, 0, 1)
-   
-
+                return_data_dict['era5'] = np.full(modality_info['n_bands'], modality_info['no_data'], dtype='float32')
 
         ### LATITUDE ###
-        if modality == 'lat':
+        elif modality == 'lat':
             return_data_dict['lat'] = np.stack([np.sin(np.deg2rad(tile_info['lat'])), np.cos(np.deg2rad(tile_info['lat']))], axis=0).astype('float32')
 
-
         ### LONGITUDE ###
-        if modality == 'lon':
+        elif modality == 'lon':
             return_data_dict['lon'] = np.stack([np.sin(np.deg2rad(tile_info['lon'])), np.cos(np.deg2rad(tile_info['lon']))], axis=0).astype('float32')
-        
+
         ### BIOME ###
-        if modality == 'biome':
-            biome = tile_info['biome']
-            one_hot = np.zeros(14)
-            one_hot[biome] = 1
+        elif modality == 'biome':
+            one_hot = np.zeros(modality_info['n_bands'])
+            one_hot[tile_info['biome']] = 1
             return_data_dict['biome'] = one_hot.astype('uint8')
 
         ### ECO-REGION ###
-        if modality == 'eco_region':
-            eco_region = tile_info['eco_region']
-            one_hot = np.zeros(846)
-            one_hot[eco_region] = 1
+        elif modality == 'eco_region':
+            one_hot = np.zeros(modality_info['n_bands'])
+            one_hot[tile_info['eco_region']] = 1
             return_data_dict['eco_region'] = one_hot.astype('uint16')
 
         ### MONTH ###
-        if modality == 'month':
-            month = tile_info['S2_DATE'].split('-')[1]
-            month = int(month)
+        elif modality == 'month':
+            month = int(tile_info['S2_DATE'].split('-')[1])
             return_data_dict['month'] = np.stack([np.sin(2 * np.pi * month / 12), np.cos(2 * np.pi * month / 12)], axis=0).astype('float32')
 
-        ## ESA WORLD COVER ###
-        if modality == 'esa_worldcover':
-            try:
-                count += len(tile_info_bands['esa_worldcover'])
-                return_data_dict['esa_worldcover'] = np.expand_dims(data[:, :, count - len(tile_info_bands['esa_worldcover'])], axis = 0)
+    return return_data_dict
+
 
+def prepare_tile(item, data_dir, img_size):
+    '''
+    Loads, checks and decodes one tile into the dictionary of its modalities. Returns (tile_id, status, data), where status is 'ok', 'missing' if the
+    tile was not downloaded, or 'mismatch' if the number of bands of the tile does not match the sum of the bands in the tile_info.
+    This runs in the worker processes of the converter, and the main process only writes the results.
+    '''
+    tile_id, tile_info = item
+    data = load_tile(data_dir, tile_id)
+    if data is None:
+        return tile_id, 'missing', None
+    _, count_t = image_offsets(tile_info['BANDS'])
+    if data.shape[-1] != count_t:
+        return tile_id, 'mismatch', None
+    return tile_id, 'ok', read_data(data, tile_info, img_size)
+
+
+def prepared_tiles(tile_info, data_dir, img_size, num_workers):
+    '''
+    Yields the results of prepare_tile for all the tiles of the tile_info, in the order of the tile_info. With num_workers > 1, the tiles are decoded
+    by a pool of processes, and the decoded tiles are sent back to this process, which is the only one that writes to the h5 file.
+    At most 2 x num_workers tiles are decoded ahead of the writer, so the decoded tiles do not pile up in memory when the writer is slower than the workers.
+    '''
+    prepare = partial(prepare_tile, data_dir=data_dir, img_size=img_size)
+    items = ((tile_id, tile_info[tile_id]) for tile_id in tile_info)
+    if num_workers <= 1:
+        yield from map(prepare, items)
+        return
+    with Pool(num_workers) as pool:
+        pending = deque()
+        for item in items:
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(prepare, (item,)))
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+
+class WriteBuffer:
+    '''
+    Buffers the samples written to a set of h5 datasets, and writes batch_size samples of each dataset at once. One hyperslab write per batch is much
+    cheaper than one small write per sample and dataset. The samples are appended from index start onwards.
+    '''
+    def __init__(self, datasets, batch_size, start = 0):
+        self.datasets = datasets
+        self.batch_size = batch_size
+        self.start = start
+        self.size = 0
+        self.buffers = {name: np.empty((batch_size, *dataset.shape[1:]), dtype=dataset.dtype) for name, dataset in datasets.items()}
+
+    def add(self, sample):
+        for name, buffer in self.buffers.items():
+            try:
+                buffer[self.size] = sample[name]
             except Exception as e:
-                print('esa_worldcover not found')
-                print('exception: ',e)
+                print('Error in modality: ', name)
+                print(e)
                 exit()
-                return_data_dict['esa_worldcover'] = np.ones((1, img_size, img_size), dtype='uint8') * 255
+        self.size += 1
+        if self.size == self.batch_size:
+            self.flush()
 
-    return return_data_dict
+    def flush(self):
+        if self.size == 0:
+            return
+        for name, dataset in self.datasets.items():
+            dataset[self.start:self.start + self.size] = self.buffers[name][:self.size]
+        self.start += self.size
+        self.size = 0
 
 
 def main(args):
@@ -215,7 +175,6 @@ def main(args):
     print('Mode: ', mode)
     if mode == 'create':
         data_dir = args.data_dir
-        data_dir = os.path.join(data_dir, 'merged')
         img_size = args.image_size
 
         # we first check if the output file already exists, if it does, we delete it
@@ -224,107 +183,59 @@ def main(args):
 
         hdf5_file = h5py.File(args.output_file, 'a')
         
-        num_tiles = len(os.listdir(data_dir))
-
         tile_info = json.load(open(args.tile_info, 'r'))
 
 
-        # we calculate the real number of tiles by verifying how many tiles
-        # have number of bands equal to the sum of the bands in the tile_info.json file
-
-        num_tiles = 0
-        for i, tile_id in enumerate(tile_info):
-            count_t = 0
-            for b in ['sentinel2', 'sentinel1_asc', 'sentinel1_desc', 'aster', 'dynamic_world', 'canopy_height_eth', 'esa_worldcover']:
-                if b in tile_info[tile_id]['BANDS']:
-                    count_t += len(tile_info[tile_id]['BANDS'][b]) if tile_info[tile_id]['BANDS'][b] is not None else 0
-
-            try:
-                data = tiff.imread(os.path.join(data_dir, tile_id + '.tif'))
-            except:
-                # sometimes the data is not downloaded, so we skip it
-                continue
-            if data.shape[-1] == count_t:
-                num_tiles += 1
-            else:
-                #  we store the lat lon in a csv file to check the tiles that have not been downloaded
-                print('Tile shape mismatch: ', tile_id)
-                lat, lon = tile_info[tile_id]['lat'], tile_info[tile_id]['lon']
-                # with open(args.missing_tiles, 'a') as f:
-                #     f.write(f'{tile_id},{lat},{lon}\n')
-
-        # num_tiles = len(tile_info)
-        print('Number of tiles: ', num_tiles)
-        print('Number of entries in tile_info: ', len(tile_info))
-        print('Number of tiles skipped due to mismatch: ', len(tile_info) - num_tiles)
-        # exit()
+        # each tile is read, checked and written in a single pass. The datasets are created for all the tiles of the tile_info, and shrunk at the end
+        # to the number of tiles that were written, hence we do not need to read all the tiles once to count them beforehand
+        max_tiles = len(tile_info)
 
-        
+        # creating a dataset for each modality, with the chunks and the codec of the layout (see utils/h5_layout.py)
+        def options(shape, dtype):
+            return dataset_options(shape, dtype, args.layout, args.codec, args.compression_level, args.shuffle, num_samples=max_tiles)
 
-        # creating a dataset for each modality
         for modality, modality_info in MODALITIES.items():
-            if modality == 'lat' or modality == 'lon' or modality == 'month':
-                variables[modality] = hdf5_file.create_dataset(modality, shape=(num_tiles, 2), dtype=modality_info['dtype'], compression='gzip', chunks=(1, 2))
-            elif modality == 'biome':
-                variables[modality] = hdf5_file.create_dataset(modality, shape=(num_tiles, 14), dtype=modality_info['dtype'], compression='gzip', chunks=(1, 14))
-            elif modality == 'eco_region':
-                variables[modality] = hdf5_file.create_dataset(modality, shape=(num_tiles, 846), dtype=modality_info['dtype'], compression='gzip', chunks=(1, 846))
-            elif modality == 'era5':
-                variables[modality] = hdf5_file.create_dataset(modality, shape=(num_tiles, modality_info['n_bands']), dtype=modality_info['dtype'], compression='gzip', chunks=(1, modality_info['n_bands']))
-            else:
-                variables[modality] = hdf5_file.create_dataset(modality, shape=(num_tiles, modality_info['n_bands'], img_size, img_size), dtype=modality_info['dtype'], compression='gzip', chunks=(1, modality_info['n_bands'], img_size, img_size))
+            shape = h5_shape(modality, img_size)
+            variables[modality] = hdf5_file.create_dataset(modality, shape=(max_tiles, *shape), maxshape=(None, *shape), dtype=modality_info['dtype'], **options(shape, modality_info['dtype']))
         
 
         # create a new meta data with tile_id and s2 type which is either l2a or l1c
         metadata_dt = np.dtype([('tile_id', 'S100'), ('S2_type', 'S10')]) # string of length 100
-        ds_metadata = hdf5_file.create_dataset('metadata', shape=(num_tiles,), dtype=metadata_dt, compression='gzip', chunks=(1,))
+        ds_metadata = hdf5_file.create_dataset('metadata', shape=(max_tiles,), maxshape=(None,), dtype=metadata_dt, **options((), metadata_dt))
 
         # metadata_dt = np.dtype([('tile_id', 'S100')]) # string of length 100
         # ds_metadata = hdf5_file.create_dataset('metadata', shape=(num_tiles,), dtype=metadata_dt, compression='gzip', chunks=(1,))
 
         j = 0
         count_s = 0
-        for i, tile_id in enumerate(tile_info):
-
-            print(f'Processing tile {i}/{num_tiles}, {tile_id}')
-            count_t = 0
+        buffer = WriteBuffer({**variables, 'metadata': ds_metadata}, args.batch_size)
+        for i, (tile_id, status, data_) in enumerate(prepared_tiles(tile_info, data_dir, img_size, args.num_workers)):
 
-            for b in ['sentinel2', 'sentinel1_asc', 'sentinel1_desc', 'aster', 'dynamic_world', 'canopy_height_eth', 'esa_worldcover']:
-                if b in tile_info[tile_id]['BANDS']:
-                    count_t += len(tile_info[tile_id]['BANDS'][b]) if tile_info[tile_id]['BANDS'][b] is not None else 0
-
-            try:
-                data = tiff.imread(os.path.join(data_dir, tile_id + '.tif'))
-            except:
+            print(f'Processing tile {i}/{max_tiles}, {tile_id}')
+            if status == 'missing':
+                # sometimes the data is not downloaded, so we skip it
                 print('Skipping tile: ', tile_id)
                 continue
 
-            if data.shape[-1] != count_t:
-                print('mismatch')
+            if status == 'mismatch':
+                print('Tile shape mismatch: ', tile_id)
                 count_s += 1
                 continue
 
-
-            data_ = read_data(tile_id, tile_info[tile_id], data_dir, img_size)
-            if data_ is None:
-                print('Skipping tile: ', tile_id)
-                continue
-            for modality, _ in MODALITIES.items():
-                try:
-                    variables[modality][j] = data_[modality]
-                except Exception as e:
-                    print('Error in modality: ', modality)
-                    print(e)
-                    exit() 
-            # breakpoint()        
-            # ds_metadata[j] = tile_id
-            ds_metadata[j] = (tile_id, tile_info[tile_id]['S2_type'])
+            data_['metadata'] = (tile_id, tile_info[tile_id]['S2_type'])
+            buffer.add(data_)
             j += 1
             # exit() ## testing
+
+        buffer.flush()
+        num_tiles = j
+        for modality in MODALITIES:
+            variables[modality].resize(num_tiles, axis=0)
+        ds_metadata.resize(num_tiles, axis=0)
         hdf5_file.close()
         print('Done!')
         print('number of tiles: ', num_tiles)
-
+        print('Number of entries in tile_info: ', len(tile_info))
         print('Number of tiles skipped due to mismatch: ', count_s)
     else:
         # we are now merging 2 h5 files
@@ -344,16 +255,7 @@ def main(args):
 
         # creating a dataset for each modality
         for modality, modality_info in MODALITIES.items():
-            if modality == 'lat' or modality == 'lon' or modality == 'month':
-                variables[modality] = hdf5_file.create_dataset(modality, shape=(size, 2), dtype=modality_info['dtype'])
-            elif modality == 'biome':
-                variables[modality] = hdf5_file.create_dataset(modality, shape=(size, 14), dtype=modality_info['dtype'])
-            elif modality == 'eco_region':
-                variables[modality] = hdf5_file.create_dataset(modality, shape=(size, 846), dtype=modality_info['dtype'])
-            elif modality == 'era5':
-                variables[modality] = hdf5_file.create_dataset(modality, shape=(size, modality_info['n_bands']), dtype=modality_info['dtype'])
-            else:
-                variables[modality] = hdf5_file.create_dataset(modality, shape=(size, modality_info['n_bands'], img_size, img_size), dtype=modality_info['dtype'])
+            variables[modality] = hdf5_file.create_dataset(modality, shape=(size, *h5_shape(modality, img_size)), dtype=modality_info['dtype'])
 
         metadata_dt = np.dtype([('tile_id', 'S100')]) # string of length 100
         ds_metadata = hdf5_file.create_dataset('metadata', shape=(size,), dtype=metadata_dt)
@@ -403,6 +305,12 @@ if __name__ == '__main__':
     parser.add_argument('--output_file', type=str, default='', help='path to the output h5 file')
     parser.add_argument('--missing_tiles', type=str, default='', help='path to the csv file containing the missing tiles')
     parser.add_argument('--image_size', type=int, default=128, help='size of the image')
+    parser.add_argument('--layout', type=str, default='sample', choices=LAYOUTS, help='chunk layout: sample (random access), scan (sequential reads) or band (per band reads)')
+    parser.add_argument('--codec', type=str, default='gzip', choices=CODECS, help='compression codec, lz4, zstd and blosc need hdf5plugin')
+    parser.add_argument('--compression_level', type=int, default=None, help='compression level of gzip, zstd and blosc, default of the codec if not set')
+    parser.add_argument('--no_shuffle', dest='shuffle', action='store_false', help='disable the byte shuffle filter before the codec')
+    parser.add_argument('--batch_size', type=int, default=256, help='number of tiles buffered in memory and written to the h5 file at once')
+    parser.add_argument('--num_workers', type=int, default=1, help='number of processes decoding the tiles, the h5 file is written by the main process')
 
 
     # args for merge mode
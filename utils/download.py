@@ -0,0 +1,121 @@
+'''
+Functions to download the files created by GEE (getDownloadUrl) to the local directory.
+'''
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.files import replace_file
+from utils.rate_limiter import get_rate_limiter
+
+
+# the first 4 bytes of a little endian and big endian TIFF, and of a BigTIFF
+TIFF_MAGIC = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
+
+
+# one session is shared by all the threads of a process, so that the connections (and the TLS handshakes) are reused between tiles and modalities
+_session = None
+_session_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    '''
+    Raised when a download fails, or when the downloaded file is incomplete or not a valid file. The file is never moved to its final path in this case.
+    '''
+    pass
+
+
+def stream_to_file(response, path, chunk_size = 1 << 20, validate_tiff = True):
+    '''
+    Streams the body of a requests response to path. The chunks are written to a temporary file in the same folder, and the file is only
+    renamed to path once it is complete and valid. Hence a crash never leaves a truncated file at path.
+    Returns the number of bytes written and the sha256 checksum of the file.
+    '''
+    folder = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.' + os.path.basename(path) + '.', suffix='.part')
+    checksum = hashlib.sha256()
+    size = 0
+    header = b''
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if not chunk:
+                    continue
+                if len(header) < 4:
+                    header += chunk[:4 - len(header)]
+                checksum.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+
+        # the content length is only comparable to the bytes written if the response is not compressed
+        expected_size = response.headers.get('Content-Length')
+        if expected_size is not None and 'Content-Encoding' not in response.headers and int(expected_size) != size:
+            raise DownloadError(f"Incomplete download for {path}: expected {expected_size} bytes, got {size}")
+        if size == 0:
+            raise DownloadError(f"Empty download for {path}")
+        if validate_tiff and header not in TIFF_MAGIC:
+            raise DownloadError(f"Downloaded file for {path} is not a TIFF file")
+
+        replace_file(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    logging.debug(f"Wrote {size} bytes to {path}, sha256: {checksum.hexdigest()}")
+    return size, checksum.hexdigest()
+
+
+def configure_session(pool_size = 16, retries = 3, backoff = 0.5):
+    '''
+    Creates the process wide requests session used for all the downloads. pool_size is the number of connections kept alive per host, and should be at least
+    the number of threads downloading at the same time. Connection errors and 5xx responses are retried retries times with an exponential backoff
+    (backoff * 2^n seconds) before the request fails. If it still fails, the @retry decorators of the export functions retry the whole download.
+    429 responses are not retried here but by rate_limited_get, so that the download rate limiter sees them.
+    '''
+    global _session
+    retry_policy = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry_policy)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.verify = False
+    with _session_lock:
+        _session = session
+    return session
+
+
+def get_session():
+    '''
+    Returns the process wide requests session. It is created with the default settings if configure_session was not called.
+    '''
+    with _session_lock:
+        session = _session
+    if session is None:
+        session = configure_session()
+    return session
+
+
+def rate_limited_get(url, **kwargs):
+    '''
+    GET request with the shared session, through the process wide 'download' rate limiter. A 429 response lowers the download rate and the request is
+    sent again, the other responses are returned as they are. kwargs are passed to session.get (e.g. stream=True).
+    '''
+    def request():
+        r = get_session().get(url, **kwargs)
+        if r.status_code == 429:
+            r.close()
+            raise DownloadError(f"Too Many Requests (status 429) for {url}")
+        return r
+    return get_rate_limiter('download').call(request)
@@ -0,0 +1,20 @@
+'''
+Helpers for the files written through a temporary file and renamed once complete (the downloads and the array store).
+'''
+
+import os
+
+
+# the umask of the process, read once since os.umask can only be read by setting it. tempfile.mkstemp creates the files with mode 0600, hence the mode
+# of a plain open() is set again before renaming, so the files stay readable by the group and the other users of the shared filesystem
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+def replace_file(tmp_path, path):
+    '''
+    Gives the temporary file the mode of a file created with open(), and renames it to path.
+    '''
+    os.chmod(tmp_path, FILE_MODE)
+    os.replace(tmp_path, path)
@@ -0,0 +1,78 @@
+'''
+Functions to compute the geometry of a tile (centroid, bounds, region) locally from the GeoJSON coordinates. The tiles are small rectangles, so
+planar computations in lon/lat are accurate enough, and we do not need a round trip to GEE for any of these values.
+'''
+
+import hashlib
+import numpy as np
+
+
+def exterior_ring(coordinates):
+    '''
+    Returns the exterior ring of a GeoJSON polygon as an (N, 2) array of lon, lat. The ring is closed, i.e. the last point is the first point.
+    '''
+    ring = np.asarray(coordinates[0], dtype=np.float64)
+    if not np.array_equal(ring[0], ring[-1]):
+        ring = np.vstack([ring, ring[:1]])
+    return ring
+
+
+def centroid(coordinates):
+    '''
+    Computes the area weighted centroid of a GeoJSON polygon using the shoelace formula. Returns (lon, lat).
+    Falls back to the mean of the vertices for degenerate polygons with zero area.
+    '''
+    ring = exterior_ring(coordinates)
+    # shifting the ring to its first vertex keeps the products small and avoids losing precision
+    origin = ring[0]
+    ring = ring - origin
+    x, y = ring[:-1, 0], ring[:-1, 1]
+    x_next, y_next = ring[1:, 0], ring[1:, 1]
+    cross = x * y_next - x_next * y
+    area = cross.sum() / 2
+    if area == 0:
+        return float(x.mean() + origin[0]), float(y.mean() + origin[1])
+    lon = ((x + x_next) * cross).sum() / (6 * area) + origin[0]
+    lat = ((y + y_next) * cross).sum() / (6 * area) + origin[1]
+    return float(lon), float(lat)
+
+
+def bounds(coordinates):
+    '''
+    Returns the bounds of a GeoJSON polygon as (min_lon, min_lat, max_lon, max_lat).
+    '''
+    ring = exterior_ring(coordinates)
+    min_lon, min_lat = ring.min(axis=0)
+    max_lon, max_lat = ring.max(axis=0)
+    return float(min_lon), float(min_lat), float(max_lon), float(max_lat)
+
+
+def tile_region(tile):
+    '''
+    Returns the region of the tile in the format expected by getDownloadUrl and the export functions. This is the same as polygon.getInfo()['coordinates'].
+    '''
+    return tile['geometry']['coordinates']
+
+
+def tile_seed(lat, lon):
+    '''
+    Generates a number based on the location of the tile. This ensures that the random choices for a tile are the same every time we download it.
+    We mod it by 10^5 to keep it small.
+    '''
+    coord_string = f"{lat}_{lon}"
+    return int(hashlib.sha256(coord_string.encode('utf-8')).hexdigest(), 16) % 10**5
+
+
+def grid_cell(bounds_, cell_size, origin):
+    '''
+    Returns the (column, row) of the cell of a regular lon/lat grid that contains the bounds, or None if the bounds overlap more than one cell.
+    origin is the (lon, lat) of the top left corner of the grid. This is used to find tiles that fall in the same pixel of a coarse dataset like ERA5.
+    '''
+    min_lon, min_lat, max_lon, max_lat = bounds_
+    col_min = int(np.floor((min_lon - origin[0]) / cell_size))
+    col_max = int(np.floor((max_lon - origin[0]) / cell_size))
+    row_min = int(np.floor((origin[1] - max_lat) / cell_size))
+    row_max = int(np.floor((origin[1] - min_lat) / cell_size))
+    if col_min != col_max or row_min != row_max:
+        return None
+    return col_min, row_min
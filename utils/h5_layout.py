@@ -0,0 +1,81 @@
+'''
+Chunk layouts and compression codecs of the datasets of the h5 files, used by convert_to_h5.py and chunking_h5.py.
+
+The layout is chosen for the way the file is read:
+    sample: one sample per chunk for the images, for the random access of the dataloader during training
+    scan:   many samples per chunk (about target_chunk_bytes), for sequential scans like the stats in normalization.py
+    band:   one band of many samples per chunk for the images, for reading a single band of the whole dataset
+The datasets that are not images (era5, lat, lon, biome, eco_region, month, metadata) are small vectors, and always have many samples per chunk. One
+chunk per row of 846 uint16 (eco_region) would mostly be chunk overhead.
+
+The codecs are gzip and lzf (built into h5py), and lz4, zstd and blosc, which need the hdf5plugin package (pip install hdf5plugin). The files written
+with these codecs can only be read with hdf5plugin imported. The byte shuffle filter is applied before the codec, which helps a lot for the int16 and
+float32 images.
+'''
+
+import numpy as np
+
+
+LAYOUTS = ['sample', 'scan', 'band']
+CODECS = ['none', 'gzip', 'lzf', 'lz4', 'zstd', 'blosc']
+DEFAULT_TARGET_CHUNK_BYTES = 1 << 20
+
+
+def chunk_shape(sample_shape, itemsize, layout = 'sample', target_chunk_bytes = DEFAULT_TARGET_CHUNK_BYTES, num_samples = None):
+    '''
+    Returns the chunk shape of a dataset with samples of sample_shape (e.g. (n_bands, img_size, img_size)) and the given item size in bytes.
+    '''
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout}, expected one of {LAYOUTS}")
+    sample_shape = tuple(sample_shape)
+    is_image = len(sample_shape) == 3
+    if is_image and layout == 'band':
+        sample_shape = (1, *sample_shape[1:])
+
+    sample_bytes = itemsize
+    for n in sample_shape:
+        sample_bytes *= n
+    if is_image and layout == 'sample':
+        rows = 1
+    else:
+        rows = max(1, target_chunk_bytes // sample_bytes)
+    if num_samples is not None:
+        rows = max(1, min(rows, num_samples))
+    return (rows, *sample_shape)
+
+
+def compression_options(codec = 'gzip', level = None, shuffle = True):
+    '''
+    Returns the create_dataset arguments of a codec: compression, compression_opts and shuffle. level is the compression level of gzip (0-9), zstd
+    (1-22) and blosc (0-9), None for the default of the codec.
+    '''
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}, expected one of {CODECS}")
+    if codec == 'none':
+        return {}
+    if codec == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4 if level is None else level, 'shuffle': shuffle}
+    if codec == 'lzf':
+        return {'compression': 'lzf', 'shuffle': shuffle}
+
+    import hdf5plugin
+    if codec == 'lz4':
+        options = dict(hdf5plugin.LZ4())
+    elif codec == 'zstd':
+        options = dict(hdf5plugin.Zstd(clevel=3 if level is None else level))
+    else:
+        # blosc does its own byte shuffle, hence the HDF5 shuffle filter is not needed
+        blosc_shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5 if level is None else level, shuffle=blosc_shuffle))
+    options['shuffle'] = shuffle
+    return options
+
+
+def dataset_options(sample_shape, dtype, layout = 'sample', codec = 'gzip', level = None, shuffle = True,
+                    target_chunk_bytes = DEFAULT_TARGET_CHUNK_BYTES, num_samples = None):
+    '''
+    Returns the create_dataset arguments (chunks and compression) of a dataset with samples of sample_shape and dtype, for a layout and a codec, e.g.
+        h5.create_dataset(name, shape=(n, *sample_shape), dtype=dtype, **dataset_options(sample_shape, dtype, 'scan', 'zstd'))
+    '''
+    chunks = chunk_shape(sample_shape, np.dtype(dtype).itemsize, layout, target_chunk_bytes, num_samples)
+    return {'chunks': chunks, **compression_options(codec, level, shuffle)}
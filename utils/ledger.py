@@ -0,0 +1,108 @@
+'''
+An on-disk ledger that records the state of every tile and modality that was downloaded. main_download.py reads it on start, and skips the tiles
+that are already complete. This replaces guessing the start indices from the tile_info files (redownload.py).
+
+The ledger is a SQLite file, so it can be shared by all the slurm jobs of a download.
+'''
+
+import sqlite3
+import threading
+import time
+
+
+PENDING = 'pending' # the tile was started but not finished, e.g. the job was killed
+DOWNLOADED = 'downloaded'
+FAILED = 'failed' # an error while getting or exporting the data, the tile is tried again on the next run
+NO_DATA = 'no_data' # there is no image of the modality for the tile (e.g. no sentinel2 image), trying again will not help
+STATES = (PENDING, DOWNLOADED, FAILED, NO_DATA)
+
+# the states for which a tile does not have to be downloaded again
+DONE_STATES = (DOWNLOADED, NO_DATA)
+
+
+class Ledger:
+    def __init__(self, path, timeout = 60):
+        '''
+        Opens (or creates) the ledger at path. timeout is the number of seconds to wait for another process that is writing to the ledger.
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS tiles (
+                    tile_id TEXT NOT NULL,
+                    modality TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (tile_id, modality)
+                )
+            ''')
+
+    def mark(self, tile_id, modalities, state):
+        '''
+        Sets the state of the given modalities of a tile.
+        '''
+        self.mark_states(tile_id, {modality: state for modality in modalities})
+
+    def mark_states(self, tile_id, states):
+        '''
+        Sets the state of each modality of a tile, given as a dictionary {modality: state}.
+        '''
+        for state in states.values():
+            if state not in STATES:
+                raise ValueError(f"Invalid state: {state}")
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO tiles (tile_id, modality, state, updated) VALUES (?, ?, ?, ?)',
+                [(tile_id, modality, state, now) for modality, state in states.items()]
+            )
+
+    def states(self, tile_id):
+        '''
+        Returns a dictionary with the state of each modality recorded for the tile.
+        '''
+        with self.lock:
+            rows = self.conn.execute('SELECT modality, state FROM tiles WHERE tile_id = ?', (tile_id,)).fetchall()
+        return dict(rows)
+
+    def completed(self, modalities, tile_ids = None):
+        '''
+        Returns the set of tile_ids for which all the given modalities are done (downloaded, or no data available).
+        If tile_ids is given, only these tiles are checked, which is much faster than reading the full ledger for a small batch of tiles.
+        '''
+        modalities = list(modalities)
+        query = f'''
+            SELECT tile_id FROM tiles
+            WHERE modality IN ({','.join('?' * len(modalities))}) AND state IN ({','.join('?' * len(DONE_STATES))}) {{}}
+            GROUP BY tile_id
+            HAVING COUNT(DISTINCT modality) = ?
+        '''
+        if tile_ids is None:
+            with self.lock:
+                rows = self.conn.execute(query.format(''), (*modalities, *DONE_STATES, len(modalities))).fetchall()
+            return set(row[0] for row in rows)
+
+        # sqlite limits the number of parameters of a query, so we check the tiles in chunks
+        tile_ids = list(tile_ids)
+        completed = set()
+        for i in range(0, len(tile_ids), 500):
+            chunk = tile_ids[i:i + 500]
+            chunk_query = query.format(f"AND tile_id IN ({','.join('?' * len(chunk))})")
+            with self.lock:
+                rows = self.conn.execute(chunk_query, (*modalities, *DONE_STATES, *chunk, len(modalities))).fetchall()
+            completed.update(row[0] for row in rows)
+        return completed
+
+    def counts(self):
+        '''
+        Returns the number of (tile, modality) entries in each state.
+        '''
+        with self.lock:
+            rows = self.conn.execute('SELECT state, COUNT(*) FROM tiles GROUP BY state').fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
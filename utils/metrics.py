@@ -0,0 +1,183 @@
+'''
+Timing metrics for the downloader. Each tile records the time spent in each stage (GEE metadata queries, each modality, getting the download urls,
+transferring and writing the files) in a TileMetrics object. The per-tile metrics are appended as JSON lines to metrics_{start}_{end}.jsonl, and the
+process wide registry keeps a histogram per stage, which is logged as a summary and written in the Prometheus text format at the end of a job.
+
+The stages of a tile:
+    metadata: the getInfo requests (sizes, dates, band names, values), summed over the modalities
+    <modality>: the time to build each modality (e.g. sentinel2, sentinel1, era5), including its metadata requests
+    url: the getDownloadUrl requests
+    transfer: downloading the files, the bytes per second are computed from the transferred bytes. For the GeoTIFF export this includes writing the file
+    write: writing the arrays to the array store (pixels export)
+    export: the full export of the tile
+    total: the full tile
+The stages of modalities that run concurrently overlap, hence their sum can be larger than the total.
+'''
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class TileMetrics:
+    def __init__(self, tile_id):
+        self.tile_id = tile_id
+        self.lock = threading.Lock()
+        self.seconds = {}
+        self.bytes = {}
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Context manager that adds the time spent inside it to the stage. A stage can be timed several times per tile, e.g. one url per image.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def add_bytes(self, name, num_bytes):
+        with self.lock:
+            self.bytes[name] = self.bytes.get(name, 0) + num_bytes
+
+    def to_dict(self):
+        with self.lock:
+            record = {'tile_id': self.tile_id, 'seconds': {name: round(s, 4) for name, s in self.seconds.items()}, 'bytes': dict(self.bytes)}
+            if self.bytes.get('transfer') and self.seconds.get('transfer'):
+                record['transfer_bytes_per_second'] = round(self.bytes['transfer'] / self.seconds['transfer'], 1)
+        return record
+
+
+class Histogram:
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value):
+        self.values.append(value)
+
+    def summary(self):
+        values = sorted(self.values)
+        summary = {'count': len(values), 'sum': sum(values), 'max': values[-1] if values else 0.0}
+        for q in QUANTILES:
+            summary[f"p{int(q * 100)}"] = quantile(values, q)
+        return summary
+
+
+def quantile(sorted_values, q):
+    '''
+    Returns the q quantile of a sorted list (nearest rank), or 0 for an empty list.
+    '''
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_seconds = {}
+        self.transfer_rate = Histogram()
+        self.num_tiles = 0
+
+    def observe_tile(self, metrics):
+        '''
+        Adds the stages of a finished tile to the histograms.
+        '''
+        record = metrics.to_dict()
+        with self.lock:
+            self.num_tiles += 1
+            for name, seconds in record['seconds'].items():
+                self.stage_seconds.setdefault(name, Histogram()).observe(seconds)
+            if 'transfer_bytes_per_second' in record:
+                self.transfer_rate.observe(record['transfer_bytes_per_second'])
+        return record
+
+    def summary(self):
+        with self.lock:
+            return {
+                'tiles': self.num_tiles,
+                'stage_seconds': {name: histogram.summary() for name, histogram in self.stage_seconds.items()},
+                'transfer_bytes_per_second': self.transfer_rate.summary(),
+            }
+
+    def prometheus_text(self, labels = None):
+        '''
+        Returns the histograms in the Prometheus text format, as summaries with the quantiles in QUANTILES, plus a gauge with the maximum.
+        labels is an optional dictionary of labels added to every sample, e.g. {'worker': '3'}.
+        '''
+        summary = self.summary()
+        labels = dict(labels or {})
+        lines = []
+
+        def add_summary(metric, help_text, samples):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} summary")
+            for extra, s in samples:
+                for q in QUANTILES:
+                    lines.append(f"{metric}{format_labels({**extra, **labels, 'quantile': q})} {s[f'p{int(q * 100)}']}")
+                lines.append(f"{metric}_sum{format_labels({**extra, **labels})} {s['sum']}")
+                lines.append(f"{metric}_count{format_labels({**extra, **labels})} {s['count']}")
+            lines.append(f"# TYPE {metric}_max gauge")
+            for extra, s in samples:
+                lines.append(f"{metric}_max{format_labels({**extra, **labels})} {s['max']}")
+
+        add_summary('mmearth_stage_seconds', 'Time spent per tile in each stage of the download.',
+                    [({'stage': name}, s) for name, s in sorted(summary['stage_seconds'].items())])
+        add_summary('mmearth_transfer_bytes_per_second', 'Download throughput per tile.', [({}, summary['transfer_bytes_per_second'])])
+        lines.append('# TYPE mmearth_tiles_total counter')
+        lines.append(f"mmearth_tiles_total{format_labels(labels)} {summary['tiles']}")
+        return '\n'.join(lines) + '\n'
+
+    def log_summary(self):
+        summary = self.summary()
+        logging.info(f"Metrics for {summary['tiles']} tiles")
+        for name, s in sorted(summary['stage_seconds'].items(), key=lambda item: -item[1]['sum']):
+            logging.info(f"\t {name}: count {s['count']}, sum {s['sum']:.1f}s, p50 {s['p50']:.2f}s, p90 {s['p90']:.2f}s, p99 {s['p99']:.2f}s, max {s['max']:.2f}s")
+        s = summary['transfer_bytes_per_second']
+        if s['count'] > 0:
+            logging.info(f"\t transfer: p50 {s['p50'] / 1e6:.2f} MB/s, p90 {s['p90'] / 1e6:.2f} MB/s")
+
+
+# the process wide registry
+_registry = MetricsRegistry()
+
+
+def get_metrics():
+    return _registry
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def append_metrics(path, record):
+    '''
+    Appends the metrics of one tile as a JSON line.
+    '''
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def write_prometheus(path, labels = None):
+    '''
+    Writes the histograms of the process wide registry to path in the Prometheus text format (e.g. for the node exporter textfile collector).
+    The file is written to a temporary file first, so that a collector never reads a partial file.
+    '''
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(_registry.prometheus_text(labels))
+    os.replace(tmp_path, path)
@@ -0,0 +1,131 @@
+'''
+The registry of the datasets and modalities. This is the single place that declares, for each dataset, the function of ee_set that gets it from GEE
+and the keys of its bands in the tile_info, and for each modality of the h5 file its bands, dtype, no data value and shape. It is used by the
+downloader (ee_data.py), the converter (convert_to_h5.py) and the stats (normalization.py).
+
+To add a dataset, write its function in ee_set, add it to DATASETS, and add the modalities it produces to MODALITIES.
+'''
+
+from functools import lru_cache
+import numpy as np
+
+
+# the datasets downloaded from GEE. fetch is the name of the ee_set function, and image_keys are the keys in tile_info['BANDS'] of the images merged
+# into the tile image (empty if the dataset is only stored in the tile_info, like era5). static datasets do not depend on the date of the tile, and
+# can be downloaded as mosaics of nearby tiles (see ee_utils/ee_mosaic.py)
+DATASETS = {
+    'sentinel2': {'fetch': 'sentinel2', 'image_keys': ['sentinel2']},
+    'sentinel1': {'fetch': 'sentinel1', 'image_keys': ['sentinel1_asc', 'sentinel1_desc']},
+    'aster': {'fetch': 'aster', 'image_keys': ['aster'], 'static': True},
+    'era5': {'fetch': 'era5', 'image_keys': []},
+    'dynamic_world': {'fetch': 'dynamic_world', 'image_keys': ['dynamic_world']},
+    'canopy_height_eth': {'fetch': 'canopy_height_eth', 'image_keys': ['canopy_height_eth'], 'static': True},
+    'esa_worldcover': {'fetch': 'esa_worldcover', 'image_keys': ['esa_worldcover'], 'static': True},
+}
+
+# the order of the images in the merged tile image. The bands of each image follow the ones of the previous images
+IMAGE_KEYS = [key for dataset in DATASETS.values() for key in dataset['image_keys']]
+
+
+# the modalities of the h5 file, in the order of the datasets in the h5 file.
+#   source: the key in tile_info['BANDS'] of the image the bands come from, or 'sentinel1' for both orbits, or 'tile_info' if the modality is computed
+#           from the tile information instead of the image
+#   bands: the bands of the modality. For the image modalities with positional: True, the channels are the bands of the image in their order,
+#          otherwise each band is looked up by its name in the bands of the image
+#   no_data: the value of the missing bands (None if a modality is never missing)
+MODALITIES = {
+    'sentinel2': {'dtype': 'uint16', 'n_bands': 13, 'source': 'sentinel2', 'no_data': 0,
+                  'bands': ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8A', 'B8', 'B9', 'B10', 'B11', 'B12']},
+    'sentinel2_cloudmask': {'dtype': 'uint16', 'n_bands': 1, 'source': 'sentinel2', 'no_data': 65535, 'bands': ['QA60']},
+    'sentinel2_cloudprod': {'dtype': 'uint16', 'n_bands': 1, 'source': 'sentinel2', 'no_data': 65535, 'bands': ['MSK_CLDPRB']},
+    'sentinel2_scl': {'dtype': 'uint8', 'n_bands': 1, 'source': 'sentinel2', 'no_data': 255, 'bands': ['SCL']},
+    'sentinel1': {'dtype': 'float32', 'n_bands': 8, 'source': 'sentinel1', 'no_data': float('-inf'),
+                  'bands': ['asc_VV', 'asc_VH', 'asc_HH', 'asc_HV', 'desc_VV', 'desc_VH', 'desc_HH', 'desc_HV']},
+    'aster': {'dtype': 'int16', 'n_bands': 2, 'source': 'aster', 'no_data': float('-inf'), 'positional': True, 'bands': ['elevation', 'slope']},
+    'era5': {'dtype': 'float32', 'n_bands': 12, 'source': 'tile_info', 'no_data': float('inf'),
+             'bands': ['prev_month_avg_temp', 'prev_month_min_temp', 'prev_month_max_temp', 'prev_month_total_precip', 'curr_month_avg_temp', 'curr_month_min_temp', 'curr_month_max_temp', 'curr_month_total_precip', 'year_avg_temp', 'year_min_temp', 'year_max_temp', 'year_total_precip']},
+    'dynamic_world': {'dtype': 'uint8', 'n_bands': 1, 'source': 'dynamic_world', 'no_data': 0, 'positional': True, 'bands': ['landcover']},
+    'canopy_height_eth': {'dtype': 'int8', 'n_bands': 2, 'source': 'canopy_height_eth', 'no_data': 255, 'positional': True, 'bands': ['height', 'std']},
+    'lat': {'dtype': 'float32', 'n_bands': 2, 'source': 'tile_info', 'no_data': float('-inf'), 'bands': ['sin', 'cos']},
+    'lon': {'dtype': 'float32', 'n_bands': 2, 'source': 'tile_info', 'no_data': float('-inf'), 'bands': ['sin', 'cos']},
+    'biome': {'dtype': 'uint8', 'n_bands': 14, 'source': 'tile_info', 'no_data': None},
+    'eco_region': {'dtype': 'uint16', 'n_bands': 846, 'source': 'tile_info', 'no_data': None},
+    'month': {'dtype': 'float32', 'n_bands': 2, 'source': 'tile_info', 'no_data': float('-inf'), 'bands': ['sin', 'cos']},
+    'esa_worldcover': {'dtype': 'uint8', 'n_bands': 1, 'source': 'esa_worldcover', 'no_data': 255, 'positional': True, 'bands': ['map']},
+}
+
+# the no data value of each modality, used to leave out the missing values from the stats
+NO_DATA_VAL = {name: modality['no_data'] for name, modality in MODALITIES.items() if modality['no_data'] is not None}
+
+
+def is_image(name):
+    return MODALITIES[name]['source'] != 'tile_info'
+
+
+def h5_shape(name, img_size):
+    '''
+    Returns the shape of one sample of the modality in the h5 file: (n_bands, img_size, img_size) for the images, and (n_bands,) otherwise.
+    '''
+    modality = MODALITIES[name]
+    if is_image(name):
+        return (modality['n_bands'], img_size, img_size)
+    return (modality['n_bands'],)
+
+
+def image_offsets(tile_bands):
+    '''
+    Returns the index of the first band of each image in the merged tile image, given the bands of the tile (tile_info['BANDS']).
+    Images that are missing for the tile (None or not in the tile_info) have no bands.
+    '''
+    offsets = {}
+    count = 0
+    for key in IMAGE_KEYS:
+        offsets[key] = count
+        count += len(tile_bands.get(key) or [])
+    return offsets, count
+
+
+@lru_cache(maxsize=1024)
+def _channel_map(name, layout):
+    modality = MODALITIES[name]
+    layout = dict(layout)
+    offsets, _ = image_offsets(layout)
+    channels = np.full(modality['n_bands'], -1, dtype=np.int64)
+    if modality['source'] == 'sentinel1':
+        for i, band in enumerate(modality['bands']):
+            orbit, polarisation = band.split('_')
+            bands = layout.get(f"sentinel1_{orbit}") or ()
+            if polarisation in bands:
+                channels[i] = offsets[f"sentinel1_{orbit}"] + bands.index(polarisation)
+    elif modality.get('positional', False):
+        bands = layout.get(modality['source']) or ()
+        for i in range(min(len(bands), modality['n_bands'])):
+            channels[i] = offsets[modality['source']] + i
+    else:
+        bands = layout.get(modality['source']) or ()
+        for i, band in enumerate(modality['bands']):
+            if band in bands:
+                channels[i] = offsets[modality['source']] + bands.index(band)
+    return channels
+
+
+def channel_map(name, tile_bands):
+    '''
+    Returns the band mapping table of an image modality for a tile: an array with, for each band of the modality, the index of the band in the merged
+    tile image, or -1 if the band is missing. The tables are cached, since most tiles share the same few band layouts.
+    '''
+    layout = tuple((key, tuple(tile_bands[key]) if tile_bands.get(key) is not None else None) for key in IMAGE_KEYS)
+    return _channel_map(name, layout)
+
+
+def extract_image_modality(name, data, tile_bands):
+    '''
+    Extracts an image modality from the (H, W, C) merged tile image, as a (n_bands, H, W) array. The missing bands are filled with the no data value.
+    '''
+    channels = channel_map(name, tile_bands)
+    valid = channels >= 0
+    no_data = MODALITIES[name]['no_data']
+    out = np.full((len(channels), data.shape[0], data.shape[1]), no_data, dtype=np.result_type(data.dtype, np.min_scalar_type(no_data)))
+    if valid.any():
+        out[valid] = data[:, :, channels[valid]].transpose(2, 0, 1)
+    return out
@@ -7,23 +7,12 @@ import json
 import numpy as np
 import h5py
 from math import inf
+import sys
+# the repo root goes first, otherwise 'utils' is utils/utils.py (the folder of this script) instead of the utils package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.modalities import NO_DATA_VAL # the no data value of each modality, declared in the modality registry
 
 
-NO_DATA_VAL = {
-    'sentinel2': 0,
-    'sentinel2_cloudmask': 65535,
-    'sentinel2_cloudprod': 65535,
-    'sentinel2_scl': 255,
-    'sentinel1': float('-inf'),
-    'aster': float('-inf'),
-    'canopy_height_eth': 255,
-    'dynamic_world': 0,
-    'esa_worldcover': 255,
-    'lat': float('-inf'),
-    'lon': float('-inf'),
-    'month': float('-inf'),
-    'era5': float('inf')
-}
 
 # DATA_PATH = "/home/qbk152/vishal/global-lr/data/data_1M_130/data_1M_130.h5"
 # TILE_INFO = "/home/qbk152/vishal/global-lr/data/data_1M_130/data_1M_130_tile_info.json"
@@ -0,0 +1,34 @@
+'''
+Helpers to run the per tile work concurrently. The work per tile is mostly waiting on the network (GEE requests and downloads), hence we use threads
+and not processes.
+'''
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def imap_ordered(func, items, num_workers = 1, max_in_flight = None):
+    '''
+    Applies func to every item using a pool of num_workers threads, and yields (item, result) in the same order as the items.
+    At most max_in_flight items are submitted at once, so the results of fast tiles do not pile up behind a slow tile.
+    func is expected to handle its own errors, any exception raised by func is re-raised here.
+    '''
+    if num_workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        in_flight = deque()
+        for item in items:
+            in_flight.append((item, executor.submit(func, item)))
+            if len(in_flight) >= max_in_flight:
+                item_, future = in_flight.popleft()
+                yield item_, future.result()
+
+        while in_flight:
+            item_, future = in_flight.popleft()
+            yield item_, future.result()
@@ -0,0 +1,134 @@
+'''
+An adaptive rate limiter for the requests to GEE and for the downloads. It is a token bucket whose rate goes down when GEE answers with a rate limit
+error (HTTP 429, "Too many concurrent aggregations", quota errors), and slowly goes up again while requests succeed (additive increase, multiplicative
+decrease). One limiter per kind of request is shared by all the threads of a process, and keeps counts of the requests, throttles and retries.
+'''
+
+import logging
+import re
+import threading
+import time
+
+
+# parts of the error messages that GEE and the http layer use when we send too many requests
+RATE_LIMIT_MESSAGES = ('too many concurrent aggregations', 'too many requests', 'quota exceeded', 'rate limit')
+# an explicit HTTP 429 status in a message, e.g. "HTTP 429" or "status 429". A bare 429 could be part of an asset id, a url or a byte count
+RATE_LIMIT_STATUS = re.compile(r'\b(http|status|error)\s*:?\s*429\b', re.IGNORECASE)
+
+
+def is_rate_limit_error(e):
+    '''
+    Returns True if the exception says that we are sending too many requests.
+    '''
+    response = getattr(e, 'response', None)
+    if getattr(response, 'status_code', None) == 429:
+        return True
+    message = str(e).lower()
+    return any(m in message for m in RATE_LIMIT_MESSAGES) or RATE_LIMIT_STATUS.search(message) is not None
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, name, rate = 20.0, min_rate = 0.5, max_rate = 100.0, increase = 1.0, decrease = 0.5, max_retries = 5, backoff = 1.0):
+        '''
+        rate is the initial number of requests per second. On a rate limit error the rate is multiplied by decrease, and every successful request
+        raises it by increase / rate, i.e. roughly by increase per second of requests. The rate always stays within [min_rate, max_rate].
+        A request that fails with a rate limit error is retried max_retries times, waiting backoff * 2^n seconds in between.
+        '''
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.tokens = 1.0
+        self.last = time.monotonic()
+        self.requests = 0
+        self.throttles = 0
+        self.retries = 0
+
+    def acquire(self):
+        '''
+        Blocks until a request can be sent.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # the bucket holds at most one second of requests, so that a burst never exceeds the current rate by much
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    self.requests += 1
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.throttles += 1
+            rate = self.rate
+        logging.debug(f"Rate limit hit for {self.name}, lowering the rate to {rate:.2f} requests/s")
+
+    def call(self, func):
+        '''
+        Calls func (without arguments) once a request can be sent, and returns its result. If func fails with a rate limit error, the rate is lowered
+        and func is retried. Other errors are raised as they are.
+        '''
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                result = func()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                self.on_throttle()
+                with self.lock:
+                    self.retries += 1
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+            self.on_success()
+            return result
+
+    def stats(self):
+        with self.lock:
+            return {'name': self.name, 'rate': round(self.rate, 2), 'requests': self.requests, 'throttles': self.throttles, 'retries': self.retries}
+
+
+# the limiters shared by all the threads of the process, one per kind of request
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def configure_rate_limiter(name, rate = 20.0, min_rate = 0.5, max_rate = 100.0, max_retries = 5, backoff = 1.0):
+    '''
+    Creates the process wide limiter with the given name.
+    '''
+    limiter = AdaptiveRateLimiter(name, rate=rate, min_rate=min_rate, max_rate=max_rate, max_retries=max_retries, backoff=backoff)
+    with _limiters_lock:
+        _limiters[name] = limiter
+    return limiter
+
+
+def get_rate_limiter(name):
+    '''
+    Returns the process wide limiter with the given name ('ee' or 'download'). It is created with the default settings if it was not configured.
+    '''
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+    if limiter is None:
+        limiter = configure_rate_limiter(name)
+    return limiter
+
+
+def rate_limiter_stats():
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return [limiter.stats() for limiter in limiters]
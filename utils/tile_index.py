@@ -0,0 +1,110 @@
+'''
+An index of the tiles geojson in a SQLite file, with one row per tile (position in the geojson, tile_id, feature as json). The geojson with 1M+ tiles
+is parsed once to build the index, and the download jobs then only read the tiles of their range, so the startup time and memory of a job depend on
+the size of its range instead of the size of the whole dataset.
+'''
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+class TileIndex:
+    def __init__(self, path, timeout = 60):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=timeout, check_same_thread=False)
+        with self.lock:
+            self.num_tiles = self.conn.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+
+    def __len__(self):
+        return self.num_tiles
+
+    def __getitem__(self, key):
+        '''
+        index[i] returns the i-th tile of the geojson, and index[start:end] the list of tiles in [start, end), like the list of features.
+        '''
+        if isinstance(key, slice):
+            start, end, step = key.indices(self.num_tiles)
+            tiles = self.range(start, end)
+            return tiles[::step] if step != 1 else tiles
+        if key < 0:
+            key += self.num_tiles
+        tiles = self.range(key, key + 1)
+        if len(tiles) == 0:
+            raise IndexError(f"Tile position {key} out of range")
+        return tiles[0]
+
+    def range(self, start, end):
+        '''
+        Returns the tiles [start, end) in the order of the geojson.
+        '''
+        with self.lock:
+            rows = self.conn.execute('SELECT feature FROM tiles WHERE position >= ? AND position < ? ORDER BY position', (start, end)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, tile_id):
+        '''
+        Returns the tile with the given tile_id, or None if it is not in the index.
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT feature FROM tiles WHERE tile_id = ?', (str(tile_id),)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_many(self, tile_ids):
+        '''
+        Returns the tiles with the given tile_ids, in the order of tile_ids. Tiles that are not in the index are left out.
+        '''
+        tile_ids = [str(tile_id) for tile_id in tile_ids]
+        found = {}
+        # sqlite limits the number of parameters of a query, so we query the tiles in chunks
+        for i in range(0, len(tile_ids), 500):
+            chunk = tile_ids[i:i + 500]
+            with self.lock:
+                rows = self.conn.execute(f"SELECT tile_id, feature FROM tiles WHERE tile_id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            found.update(rows)
+        return [json.loads(found[tile_id]) for tile_id in tile_ids if tile_id in found]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def build_tile_index(geojson_path, index_path, batch_size = 10000):
+    '''
+    Builds the index of a tiles geojson. The index is written to a temporary file and renamed once it is complete, so a job never opens a partial
+    index, and several jobs building the same index at the same time do not break it.
+    '''
+    logging.info(f"Building the tile index {index_path} from {geojson_path}")
+    with open(geojson_path, 'r') as f:
+        features = json.load(f)['features']
+
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    with conn:
+        conn.execute('CREATE TABLE tiles (position INTEGER PRIMARY KEY, tile_id TEXT NOT NULL, feature TEXT NOT NULL)')
+        for start in range(0, len(features), batch_size):
+            conn.executemany(
+                'INSERT INTO tiles (position, tile_id, feature) VALUES (?, ?, ?)',
+                [(start + i, str(feature['properties']['tile_id']), json.dumps(feature)) for i, feature in enumerate(features[start:start + batch_size])]
+            )
+        # not unique, since a tile_id could appear twice in a geojson (see preflight.py)
+        conn.execute('CREATE INDEX tiles_tile_id ON tiles (tile_id)')
+    conn.close()
+    os.replace(tmp_path, index_path)
+    logging.info(f"Indexed {len(features)} tiles")
+
+
+def open_tile_index(index_path, geojson_path = None):
+    '''
+    Opens the tile index at index_path. If it does not exist yet, it is built from geojson_path.
+    '''
+    if not os.path.exists(index_path):
+        if geojson_path is None:
+            raise FileNotFoundError(f"Tile index {index_path} does not exist")
+        build_tile_index(geojson_path, index_path)
+    return TileIndex(index_path)
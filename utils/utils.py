@@ -1,10 +1,8 @@
 import time
 import geojson
 import logging
-import ee
 import os
 import glob
-import config.ee_init
 import json
 
 
@@ -16,15 +14,61 @@ def read_geojson(path):
         gj = geojson.load(f)
     return gj
 
+def append_tile_info(path, tile_id, info):
+    '''
+    Appends the information of one tile to a tile_info file in the JSON Lines format. Each line is a dictionary {tile_id: info}.
+    Unlike rewriting the whole json after every tile, the cost of writing a tile does not grow with the number of tiles already written.
+    '''
+    with open(path, 'a') as f:
+        f.write(json.dumps({tile_id: info}) + '\n')
+
+
+def read_tile_info(path):
+    '''
+    Reads a tile_info file and returns a dictionary {tile_id: info}. Both the json format (one dictionary) and the JSON Lines format (.jsonl) are supported.
+    For the JSON Lines format, the last line of a tile wins, and an incomplete last line (e.g. the job was killed while writing) is ignored.
+    '''
+    if not path.endswith('.jsonl'):
+        return read_geojson(path)
+
+    tile_info_dict = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                tile_info_dict.update(json.loads(line))
+            except json.JSONDecodeError:
+                logging.warning(f"Skipping an incomplete line in {path}")
+    return tile_info_dict
+
+
+def compact_tile_info(path):
+    '''
+    Rewrites a JSON Lines tile_info file with one line per tile, removing the older lines of tiles that were written more than once.
+    The file is written to a temporary file first and then renamed, so the tile_info is never lost if the job is killed during compaction.
+    '''
+    tile_info_dict = read_tile_info(path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for tile_id, info in tile_info_dict.items():
+            f.write(json.dumps({tile_id: info}) + '\n')
+    os.replace(tmp_path, path)
+    return len(tile_info_dict)
+
+
 def merge_dicts(in_path, out_path = 'data/data_100k_130_tile_info.json'):
     '''
-    Merges the dictionaries from the tile_info json files.
+    Merges the dictionaries from the tile_info json and jsonl files.
     '''
 
     # reading all the tile json files
     tile_info_dict = {}
     for tile_name in glob.glob(f'{in_path}/tile_info_*'):
-        tmp = read_geojson(tile_name)
+        if tile_name.endswith('.tmp'):
+            continue
+        tmp = read_tile_info(tile_name)
         tile_info_dict = tmp | tile_info_dict
 
     # writing the merged dictionary to a file
@@ -49,22 +93,18 @@ def create_missing_tiles_geojson():
         'features': []
     }
 
-    # reading the tile geojson file
-    gj = read_geojson(tile_geojson)
-    features = gj['features']
+    # the tiles are looked up by tile_id in the index of the tile geojson, which is built on the first call
+    from utils.tile_index import open_tile_index
+    index = open_tile_index(tile_geojson + '.db', tile_geojson)
 
     # reading the missing tiles csv file
+    tile_names = []
     for line in open(missing_tiles_csv):
         line = line.strip()
         line = line.split(',')
-        tile_name = line[0]
-        print('Processing tile: ', tile_name)
-
-        # finding the tile in the tile geojson file
-        for feature in features:
-            if feature['properties']['tile_id'] == tile_name:
-                geojson['features'].append(feature)
-                break
+        tile_names.append(line[0])
+    geojson['features'] = index.get_many(tile_names)
+    index.close()
 
     # writing the geojson file
     print('Total missing tiles: ', len(geojson['features']))
@@ -88,6 +128,9 @@ def update_tile_info(tile, ee_set_, tile_info = None):
         new_bands = ee_set_.img_bands
         bands = existing_bands | new_bands
         tile_info['BANDS'] = bands
+        # the size and sha256 of the downloaded files, to check them later
+        if len(ee_set_.downloaded) > 0:
+            tile_info['FILES'] = tile_info.get('FILES', {}) | ee_set_.downloaded
 
         # # HARDCODED: adding the era5 data to the tile_info
         # if len(ee_set_.era5_data) > 0:
@@ -96,7 +139,7 @@ def update_tile_info(tile, ee_set_, tile_info = None):
     else:
         return_dict = {}
         return_dict['S2_DATE'] = ee_set_.s2_date
-        # return_dict['S2_IMAGEID'] = ee_set_.s2_imageid
+        return_dict['S2_IMAGEID'] = ee_set_.s2_imageid
         return_dict['S2_type'] = ee_set_.s2_type
         return_dict['CRS'] = ee_set_.crs
         return_dict['lat'] = ee_set_.lat
@@ -105,6 +148,8 @@ def update_tile_info(tile, ee_set_, tile_info = None):
         return_dict['eco_region'] = ee_set_.eco_region
         return_dict['NO_DATA'] = ee_set_.no_data
         return_dict['BANDS'] = ee_set_.img_bands
+        if len(ee_set_.downloaded) > 0:
+            return_dict['FILES'] = ee_set_.downloaded
         if len(ee_set_.era5_data) > 0:
             return_dict['era5'] = ee_set_.era5_data
         return return_dict
@@ -112,6 +157,8 @@ def update_tile_info(tile, ee_set_, tile_info = None):
 
 
 def get_points_filter(roi, buffer_size=0):
+    # imported here, so that the offline tools (h5 conversion, stats) can import this module without the GEE backend
+    from ee_utils.backend import ee
     pnt_roi = roi.buffer(buffer_size, ee.ErrorMargin(1)).bounds()
     coord_list = ee.List(pnt_roi.coordinates().get(0))
     b_left = ee.Geometry.Point(coord_list.get(0))
@@ -132,6 +179,7 @@ def get_ee_task_list():
     Gets the list of all the tasks in the EE project.
     '''
     tasks = []
+    from ee_utils.backend import ee
     task_list = ee.data.getTaskList()
     for task in task_list:
         if task['state'] in ['RUNNING', 'READY']:
@@ -0,0 +1,127 @@
+'''
+A shared work queue for the slurm array jobs. Instead of giving each job a fixed range of tiles, the tiles are split into small batches, and each
+worker leases one batch at a time from a SQLite file on the shared filesystem. Fast workers simply lease more batches. A lease expires after
+lease_seconds, so the batch of a worker that died is given to another worker. A batch that was leased max_attempts times without being completed
+(e.g. it kills every worker that downloads it) is marked as failed instead of being given to yet another worker.
+'''
+
+import sqlite3
+import threading
+import time
+
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class LeaseLost(Exception):
+    '''
+    Raised when the lease of a batch expired, and the batch may have been leased by another worker.
+    '''
+    pass
+
+
+class WorkQueue:
+    def __init__(self, path, timeout = 60, max_attempts = None):
+        '''
+        Opens (or creates) the queue at path. timeout is the number of seconds to wait for another worker that is writing to the queue. max_attempts is
+        the number of leases of a batch before it is marked as failed, None to lease it again forever.
+        '''
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # isolation_level=None since we handle the transactions ourselves (BEGIN IMMEDIATE), so that two workers never lease the same batch
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS batches (
+                    batch_id INTEGER PRIMARY KEY,
+                    start INTEGER NOT NULL,
+                    end INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    UNIQUE (start, end)
+                )
+            ''')
+
+    def populate(self, start, end, batch_size):
+        '''
+        Splits the tiles [start, end) into batches of batch_size tiles. Batches that already exist are kept as they are, hence all the workers can call
+        this on start, and a restarted queue continues where it stopped.
+        '''
+        batches = [(s, min(s + batch_size, end), PENDING) for s in range(start, end, batch_size)]
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany('INSERT OR IGNORE INTO batches (start, end, state) VALUES (?, ?, ?)', batches)
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def lease(self, worker, lease_seconds):
+        '''
+        Leases the next batch that is pending, or whose lease has expired. Returns (batch_id, start, end), or None if there is no batch left.
+        '''
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self.max_attempts is not None:
+                    # the expired batches that were already leased max_attempts times are not given to another worker
+                    self.conn.execute(
+                        'UPDATE batches SET state = ?, lease_expires = NULL WHERE state = ? AND lease_expires < ? AND attempts >= ?',
+                        (FAILED, LEASED, now, self.max_attempts)
+                    )
+                row = self.conn.execute(
+                    'SELECT batch_id, start, end FROM batches WHERE state = ? OR (state = ? AND lease_expires < ?) ORDER BY batch_id LIMIT 1',
+                    (PENDING, LEASED, now)
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        'UPDATE batches SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE batch_id = ?',
+                        (LEASED, worker, now + lease_seconds, row[0])
+                    )
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return row
+
+    def renew(self, batch_id, worker, lease_seconds):
+        '''
+        Extends the lease of a batch. Returns False if the lease was lost, i.e. it expired and the batch was leased by another worker.
+        '''
+        with self.lock:
+            cursor = self.conn.execute(
+                'UPDATE batches SET lease_expires = ? WHERE batch_id = ? AND worker = ? AND state = ?',
+                (time.time() + lease_seconds, batch_id, worker, LEASED)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, batch_id, worker):
+        '''
+        Marks a batch as done. Returns False if the lease was lost, in which case the batch is left to the worker that holds it now.
+        '''
+        with self.lock:
+            cursor = self.conn.execute(
+                'UPDATE batches SET state = ?, lease_expires = NULL WHERE batch_id = ? AND worker = ? AND state = ?',
+                (DONE, batch_id, worker, LEASED)
+            )
+        return cursor.rowcount == 1
+
+    def counts(self):
+        '''
+        Returns the number of batches in each state.
+        '''
+        with self.lock:
+            rows = self.conn.execute('SELECT state, COUNT(*) FROM batches GROUP BY state').fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()